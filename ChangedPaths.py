@@ -0,0 +1,221 @@
+import os
+import mmap
+import struct
+import hashlib
+
+from Differ import Differ
+from CommitGraph import CommitGraph
+from utils import LockFile
+
+
+# bloom filters of the paths changed by every commit against its first parent, a sidecar of the
+# commit-graph. a path absent from the filter of a commit is known to be unchanged by it.
+#   header | sha1s | filter end offsets | filters | checksum
+# the changed files and all their parent dirs are added. a commit changing too many paths gets
+# the one byte filter 0xff, which can't rule anything out.
+# the filters of new commits are appended as layers of the same format, listed bottom up in
+# commit-graphs/commit-graph-bloom-chain. a new layer is merged with the layers below it that have less
+# than __merge_factor times its filters, the base file included
+class ChangedPaths():
+    __instance = None
+    __init = False
+
+    __magic = b"BLOM"
+    __version = 1
+    __header = struct.Struct("!4sLLL")
+    __end = struct.Struct("!L")
+    __hashlen = 20
+    __checksum_len = 40
+    __nhashes = 7
+    __bits_per_path = 10
+    __max_paths = 512
+    __merge_factor = 2
+
+    # the tables of one file, name is None for the base file
+    class Layer():
+        __slots__ = ("name", "data", "count", "ends_offset", "filters_offset")
+
+        def __init__(self, name, data, count, header_len, hashlen, end_len):
+            self.name = name
+            self.data = data
+            self.count = count
+            self.ends_offset = header_len + count * hashlen
+            self.filters_offset = self.ends_offset + count * end_len
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        info_dir = os.path.join(repo_path, ".git", "objects", "info")
+        self.__path = os.path.join(info_dir, "commit-graph-bloom")
+        self.__layers_dir = os.path.join(info_dir, "commit-graphs")
+        self.__chain_path = os.path.join(self.__layers_dir, "commit-graph-bloom-chain")
+        # bottom up, the base file first
+        self.__layers = []
+        self.__load()
+
+    def __load(self):
+        layers = []
+        base = self.__load_layer(None, self.__path)
+        if base is not None:
+            layers.append(base)
+            if os.path.exists(self.__chain_path):
+                with open(self.__chain_path, "r") as f:
+                    names = f.read().split()
+                for name in names:
+                    layer = self.__load_layer(name, self.__get_layer_path(name))
+                    # a layer removed by a merge, the rest of the chain is stale
+                    if layer is None:
+                        break
+                    layers.append(layer)
+        self.__layers = layers
+
+    def __load_layer(self, name, path):
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        magic, version, count, nhashes = self.__header.unpack_from(data, 0)
+        assert magic == self.__magic, "bloom filters magic check error"
+        assert version == self.__version, "bloom filters version check error"
+        assert nhashes == self.__nhashes, "bloom filters hash count mismatch"
+        return self.Layer(name, data, count, self.__header.size, self.__hashlen, self.__end.size)
+
+    def __get_layer_path(self, name):
+        return os.path.join(self.__layers_dir, f"bloom-{name}.bloom")
+
+    def exists(self):
+        return len(self.__layers) != 0
+
+    def __getsha1(self, layer, pos):
+        offset = self.__header.size + pos * self.__hashlen
+        return layer.data[offset:offset + self.__hashlen].decode()
+
+    # (layer, position) of the filter of sha1, (None, None) if it has none
+    def __find(self, sha1):
+        if len(sha1) != self.__hashlen:
+            return None, None
+        key = sha1.encode()
+        for layer in reversed(self.__layers):
+            lo, hi = 0, layer.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                offset = self.__header.size + mid * self.__hashlen
+                if layer.data[offset:offset + self.__hashlen] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < layer.count and self.__getsha1(layer, lo) == sha1:
+                return layer, lo
+        return None, None
+
+    def __get_filter(self, layer, pos):
+        start = self.__end.unpack_from(layer.data, layer.ends_offset + (pos - 1) * self.__end.size)[0] \
+            if pos > 0 else 0
+        end = self.__end.unpack_from(layer.data, layer.ends_offset + pos * self.__end.size)[0]
+        return layer.data[layer.filters_offset + start:layer.filters_offset + end]
+
+    @classmethod
+    def __bits(cls, path, nbits):
+        digest = hashlib.sha1(path.encode()).digest()
+        h1 = int.from_bytes(digest[0:4], "big")
+        h2 = int.from_bytes(digest[4:8], "big") | 1
+        return [(h1 + i * h2) % nbits for i in range(cls.__nhashes)]
+
+    # False if the commit surely doesn't change path, True if it may, None if it has no filter
+    def maybe_changed(self, sha1, path):
+        layer, pos = self.__find(sha1)
+        if layer is None:
+            return None
+        bloom = self.__get_filter(layer, pos)
+        return all(bloom[bit >> 3] & (1 << (bit & 7)) for bit in self.__bits(path, len(bloom) * 8))
+
+    # add the filters of the commits sha1s that have none yet as a new layer. the first filters make
+    # the base file. without must_lock nothing is added while another process is writing, the commits
+    # left out get their filters from the next commit-graph write --changed-paths
+    def add(self, sha1s, must_lock=True):
+        os.makedirs(self.__layers_dir, exist_ok=True)
+        with LockFile(self.__chain_path, must_lock) as chain_lock:
+            if not chain_lock.islocked():
+                return 0
+            self.__load()
+            filters = dict()
+            for sha1 in sha1s:
+                if sha1 not in filters and self.__find(sha1)[0] is None:
+                    filters[sha1] = self.__build_filter(sha1)
+            if len(filters) == 0 and self.exists():
+                return 0
+            nnew = len(filters)
+
+            layers = self.__layers
+            while len(layers) != 0 and layers[-1].count < self.__merge_factor * len(filters):
+                for pos in range(layers[-1].count):
+                    filters[self.__getsha1(layers[-1], pos)] = bytes(self.__get_filter(layers[-1], pos))
+                layers = layers[:-1]
+
+            if len(layers) == 0:
+                with LockFile(self.__path) as lock:
+                    lock.write(self.__serialize(filters))
+                    lock.commit()
+                if os.path.exists(self.__chain_path):
+                    os.unlink(self.__chain_path)
+                self.__remove_unused_layers([])
+            else:
+                data = self.__serialize(filters)
+                names = [layer.name for layer in layers[1:]] + [data[-self.__checksum_len:].decode()]
+                with LockFile(self.__get_layer_path(names[-1])) as lock:
+                    lock.write(data)
+                    lock.commit()
+                chain_lock.write("".join(f"{name}\n" for name in names).encode())
+                chain_lock.commit()
+                self.__remove_unused_layers(names)
+            self.__load()
+        return nnew
+
+    def __serialize(self, filters):
+        sha1s = sorted(filters.keys())
+        ends = []
+        end = 0
+        for sha1 in sha1s:
+            end += len(filters[sha1])
+            ends.append(self.__end.pack(end))
+        data = b"".join([self.__header.pack(self.__magic, self.__version, len(sha1s), self.__nhashes)] +
+                        [sha1.encode() for sha1 in sha1s] + ends + [filters[sha1] for sha1 in sha1s])
+        return data + hashlib.sha1(data).hexdigest().encode()
+
+    def __remove_unused_layers(self, names):
+        names = set(names)
+        for filename in os.listdir(self.__layers_dir):
+            if filename.startswith("bloom-") and filename.endswith(".bloom") and \
+                    filename[len("bloom-"):-len(".bloom")] not in names:
+                os.unlink(os.path.join(self.__layers_dir, filename))
+
+    def __build_filter(self, sha1):
+        graph = CommitGraph(self.__repo_path)
+        parents = graph.get_parent_sha1s(sha1)
+        old_tree = graph.get_tree_sha1(parents[0]) if len(parents) != 0 else None
+        fchanged, fcreate, fdelete = Differ(self.__repo_path).diff_trees(
+            old_tree, graph.get_tree_sha1(sha1))
+
+        paths = set()
+        for path in list(fchanged) + list(fcreate) + list(fdelete):
+            while path != "" and path not in paths:
+                paths.add(path)
+                path = os.path.dirname(path)
+            if len(paths) > self.__max_paths:
+                return b"\xff"
+
+        nbits = max(8, (len(paths) * self.__bits_per_path + 7) // 8 * 8)
+        bloom = bytearray(nbits // 8)
+        for path in paths:
+            for bit in self.__bits(path, nbits):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        return bytes(bloom)
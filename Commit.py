@@ -1,3 +1,6 @@
+import time
+import textwrap
+
 from Tree import Tree
 
 
@@ -25,6 +28,13 @@ class Commit():
         self.__tree_sha1 = tree_sha1
         self.__parent_sha1s = parent_sha1s
         self.__msg = msg
+        # the time is fixed when the commit is built, so that serializing it again gives the same sha1
+        self.__timesample = int(time.time())
+        utc_offset = -time.timezone
+        self.__zone_offset = int('{}{:02}{:02}'.format(
+            '+' if utc_offset > 0 else '-',
+            abs(utc_offset) // 3600,
+            (abs(utc_offset) // 60) % 60))
 
     def build_from_bytes(self, cdata):
         cdata = cdata.decode()
@@ -52,13 +62,10 @@ class Commit():
         self.__msg = "".join(lines[1 + len(self.__parent_sha1s) + 2:])
 
     def serialization(self):
-        timestamp = int(time.mktime(time.localtime()))
-        utc_offset = -time.timezone
-        author_time = '{} {}{:02}{:02}'.format(
-            timestamp,
-            '+' if utc_offset > 0 else '-',
-            abs(utc_offset) // 3600,
-            (abs(utc_offset) // 60) % 60)
+        author_time = '{} {}{:04}'.format(
+            int(self.__timesample),
+            '+' if self.__zone_offset >= 0 else '-',
+            abs(self.__zone_offset))
 
         content = f"tree {self.__tree_sha1}\n"
         for parent_sha1 in self.__parent_sha1s:
@@ -76,6 +83,12 @@ class Commit():
     def get_tree_sha1(self):
         return self.__tree_sha1
 
+    def get_timestamp(self):
+        return self.__timesample
+
+    def get_msg(self):
+        return self.__msg
+
     def __str__(self):
         out = f"tree:   {self.__tree_sha1}\n"
         for parent_sha1 in self.__parent_sha1s:
@@ -0,0 +1,391 @@
+import os
+import mmap
+import struct
+import hashlib
+
+from Object import Object
+from Ref import Head, Branch, Tag
+from utils import LockFile
+
+
+# commit-graph file: the tree, parents, commit time and generation number of every commit in a fixed
+# width table sorted by sha1, so that history walks needn't inflate and parse the commit objects.
+#   header | sha1s | records | extra parents | checksum
+# record: tree sha1 | parent 1 | parent 2 | generation | time. a parent is the position of its record,
+# __no_parent if there is none, or (__extra_flag | index into the extra parents) for octopus merges
+# whose parents 2.. are listed there, the last one flagged with __extra_flag
+#
+# new commits are appended as layers on top of it, listed bottom up in commit-graphs/commit-graph-chain.
+# a layer has the same tables for its own commits, its header also holds the number of commits below it
+# and its positions count those first. a new layer is merged with the layers below it that are less than
+# __merge_factor times its size, so that a commit only copies an amortized O(log n) records
+class CommitGraph():
+    __instance = None
+    __init = False
+
+    __magic = b"CGPH"
+    __layer_magic = b"CGPL"
+    __version = 1
+    __header = struct.Struct("!4sLLL")
+    __layer_header = struct.Struct("!4sLLLL")
+    __record = struct.Struct("!20sLLLq")
+    __extra = struct.Struct("!L")
+    __hashlen = 20
+    __checksum_len = 40
+    __no_parent = 0x7FFFFFFF
+    __extra_flag = 0x80000000
+    __merge_factor = 2
+
+    # the tables of one file, positions are local to it. name is None for the base file
+    class Layer():
+        __slots__ = ("name", "data", "count", "nbase", "sha1s_offset", "records_offset", "extra_offset")
+
+        def __init__(self, name, data, header_len, count, nbase, hashlen, record_len):
+            self.name = name
+            self.data = data
+            self.count = count
+            self.nbase = nbase
+            self.sha1s_offset = header_len
+            self.records_offset = header_len + count * hashlen
+            self.extra_offset = self.records_offset + count * record_len
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        info_dir = os.path.join(repo_path, ".git", "objects", "info")
+        self.__path = os.path.join(info_dir, "commit-graph")
+        self.__layers_dir = os.path.join(info_dir, "commit-graphs")
+        self.__chain_path = os.path.join(self.__layers_dir, "commit-graph-chain")
+        # bottom up, the base file first
+        self.__layers = []
+        self.__count = 0
+        self.__stamp = None
+        self.__load()
+
+    def __getstamp(self, path):
+        try:
+            fstat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (fstat.st_mtime_ns, fstat.st_size, fstat.st_ino)
+
+    def __load(self):
+        stamp = (self.__getstamp(self.__path), self.__getstamp(self.__chain_path))
+        if stamp == self.__stamp:
+            return
+
+        layers = []
+        if stamp[0] is not None:
+            with open(self.__path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, nextra = self.__header.unpack_from(data, 0)
+            assert magic == self.__magic, "commit-graph magic check error"
+            assert version == self.__version, "commit-graph version check error"
+            assert len(data) == self.__header.size + count * (self.__hashlen + self.__record.size) + \
+                nextra * self.__extra.size + self.__checksum_len, "commit-graph is incompleted"
+            layers.append(self.Layer(None, data, self.__header.size, count, 0,
+                                     self.__hashlen, self.__record.size))
+        if stamp[1] is not None and len(layers) != 0:
+            with open(self.__chain_path, "r") as f:
+                names = f.read().split()
+            for name in names:
+                layer = self.__load_layer(name, layers[-1].nbase + layers[-1].count)
+                # a layer removed or not built on the layers below, the rest of the chain is stale
+                if layer is None:
+                    break
+                layers.append(layer)
+
+        self.__layers, self.__stamp = layers, stamp
+        self.__count = sum(layer.count for layer in layers)
+
+    def __load_layer(self, name, nbase):
+        try:
+            with open(self.__get_layer_path(name), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        magic, version, count, nextra, layer_nbase = self.__layer_header.unpack_from(data, 0)
+        if magic != self.__layer_magic or version != self.__version or layer_nbase != nbase or \
+                len(data) != self.__layer_header.size + count * (self.__hashlen + self.__record.size) + \
+                nextra * self.__extra.size + self.__checksum_len:
+            return None
+        return self.Layer(name, data, self.__layer_header.size, count, nbase,
+                          self.__hashlen, self.__record.size)
+
+    def __get_layer_path(self, name):
+        return os.path.join(self.__layers_dir, f"graph-{name}.graph")
+
+    def exists(self):
+        return len(self.__layers) != 0
+
+    def getcount(self):
+        return self.__count
+
+    # layer and local position of a position
+    def __locate(self, pos):
+        for layer in self.__layers:
+            if pos < layer.nbase + layer.count:
+                return layer, pos - layer.nbase
+        assert False, f"commit-graph position {pos} is out of range"
+
+    def __getsha1(self, pos):
+        layer, pos = self.__locate(pos)
+        offset = layer.sha1s_offset + pos * self.__hashlen
+        return layer.data[offset:offset + self.__hashlen].decode()
+
+    # position of sha1 in the graph, None if it isn't in the graph. only the layers are searched
+    # if they are given
+    def __find(self, sha1, layers=None):
+        if len(sha1) != self.__hashlen:
+            return None
+        key = sha1.encode()
+        for layer in reversed(self.__layers if layers is None else layers):
+            lo, hi = 0, layer.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                offset = layer.sha1s_offset + mid * self.__hashlen
+                if layer.data[offset:offset + self.__hashlen] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            offset = layer.sha1s_offset + lo * self.__hashlen
+            if lo < layer.count and layer.data[offset:offset + self.__hashlen] == key:
+                return layer.nbase + lo
+        return None
+
+    # (tree sha1, parent positions, generation, time) of the record at pos
+    def __read_record(self, pos):
+        layer, pos = self.__locate(pos)
+        tree, parent1, parent2, generation, ctime = self.__record.unpack_from(
+            layer.data, layer.records_offset + pos * self.__record.size)
+        parents = []
+        if parent1 != self.__no_parent:
+            parents.append(parent1)
+        if parent2 & self.__extra_flag:
+            i = parent2 & ~self.__extra_flag
+            while True:
+                (parent,) = self.__extra.unpack_from(
+                    layer.data, layer.extra_offset + i * self.__extra.size)
+                parents.append(parent & ~self.__extra_flag)
+                if parent & self.__extra_flag:
+                    break
+                i += 1
+        elif parent2 != self.__no_parent:
+            parents.append(parent2)
+        return tree.decode(), parents, generation, ctime
+
+    def has_commit(self, sha1):
+        return self.__find(sha1) is not None
+
+    # the getters fall back to the commit object when it isn't in the graph yet
+    def get_parent_sha1s(self, sha1):
+        pos = self.__find(sha1)
+        if pos is None:
+            return self.__read_commit(sha1).get_parent_sha1s()
+        return [self.__getsha1(parent) for parent in self.__read_record(pos)[1]]
+
+    def get_tree_sha1(self, sha1):
+        pos = self.__find(sha1)
+        if pos is None:
+            return self.__read_commit(sha1).get_tree_sha1()
+        return self.__read_record(pos)[0]
+
+    def get_time(self, sha1):
+        pos = self.__find(sha1)
+        if pos is None:
+            return self.__read_commit(sha1).get_timestamp()
+        return self.__read_record(pos)[3]
+
+    # None when the commit isn't in the graph
+    def get_generation(self, sha1):
+        pos = self.__find(sha1)
+        if pos is None:
+            return None
+        return self.__read_record(pos)[2]
+
+    def __read_commit(self, sha1):
+        obj = Object(sha1, self.__repo_path)
+        assert obj.iscommit(), f"{sha1} is not a commit"
+        return obj.getrawobj()
+
+    # whether ancestor is reachable from sha1. commits with a generation lower than the one of
+    # ancestor can't reach it, so the walk never goes below it
+    def is_ancestor(self, ancestor, sha1):
+        min_generation = self.get_generation(ancestor) or 0
+        seen = set()
+        stack = [sha1]
+        while len(stack) != 0:
+            cur = stack.pop()
+            if cur == ancestor:
+                return True
+            if cur in seen:
+                continue
+            seen.add(cur)
+            generation = self.get_generation(cur)
+            if generation is not None and generation <= min_generation:
+                continue
+            stack.extend(self.get_parent_sha1s(cur))
+        return False
+
+    # rewrite the whole graph as a single file with every commit reachable from the refs
+    def write(self):
+        tips = list(Branch.get_branches(self.__repo_path).values()) + \
+            list(Tag.get_tags(self.__repo_path).values()) + \
+            [Head(self.__repo_path).get_sha1()]
+        os.makedirs(self.__layers_dir, exist_ok=True)
+        with LockFile(self.__chain_path):
+            self.__load()
+            commits = dict()
+            for layer in self.__layers:
+                commits.update(self.__read_layer(layer))
+            commits.update(self.__read_new_commits([sha1 for sha1 in tips if sha1], commits))
+            self.__compute_generations(commits)
+            self.__write_base(commits)
+        return len(commits)
+
+    # add the commits reachable from sha1s as a new layer, merged with the small layers below it.
+    # nothing is done if there is no graph yet, or if another process is writing it: the commits left
+    # out are found again from the next update
+    def update(self, sha1s):
+        self.__load()
+        if not self.exists():
+            return 0
+        os.makedirs(self.__layers_dir, exist_ok=True)
+        with LockFile(self.__chain_path, must_lock=False) as chain_lock:
+            if not chain_lock.islocked():
+                return 0
+            self.__load()
+            commits = self.__read_new_commits(sha1s, dict())
+            if len(commits) == 0:
+                return 0
+            nnew = len(commits)
+
+            layers = self.__layers
+            while len(layers) != 0 and layers[-1].count < self.__merge_factor * len(commits):
+                commits.update(self.__read_layer(layers[-1]))
+                layers = layers[:-1]
+            self.__compute_generations(commits)
+
+            if len(layers) == 0:
+                self.__write_base(commits)
+            else:
+                names = [layer.name for layer in layers[1:]] + [self.__write_layer(commits, layers)]
+                chain_lock.write("".join(f"{name}\n" for name in names).encode())
+                chain_lock.commit()
+                self.__remove_unused_layers(names)
+            self.__load()
+        return nnew
+
+    # sha1 -> (tree sha1, parent sha1s, time, generation) of the commits of a layer
+    def __read_layer(self, layer):
+        commits = dict()
+        for pos in range(layer.nbase, layer.nbase + layer.count):
+            tree, parents, generation, ctime = self.__read_record(pos)
+            commits[self.__getsha1(pos)] = (tree, [self.__getsha1(parent) for parent in parents],
+                                            ctime, generation)
+        return commits
+
+    # the commits reachable from tips that are neither known nor in the graph, without generations yet
+    def __read_new_commits(self, tips, known):
+        commits = dict()
+        stack = list(tips)
+        while len(stack) != 0:
+            sha1 = stack.pop()
+            if sha1 in commits or sha1 in known or self.__find(sha1) is not None:
+                continue
+            commit = self.__read_commit(sha1)
+            commits[sha1] = (commit.get_tree_sha1(), commit.get_parent_sha1s(),
+                             int(commit.get_timestamp()), None)
+            stack.extend(commit.get_parent_sha1s())
+        return commits
+
+    # generation: 1 for a root commit, otherwise 1 + the max generation of its parents. only the
+    # commits without one are computed, the generations of the parents in the graph are read
+    def __compute_generations(self, commits):
+        def get_generation(sha1):
+            return commits[sha1][3] if sha1 in commits else self.get_generation(sha1)
+
+        for sha1 in commits:
+            stack = [sha1]
+            while len(stack) != 0:
+                cur = stack[-1]
+                if commits[cur][3] is not None:
+                    stack.pop()
+                    continue
+                pending = [parent for parent in commits[cur][1] if get_generation(parent) is None]
+                if len(pending) != 0:
+                    stack.extend(pending)
+                    continue
+                tree, parents, ctime, _ = commits[cur]
+                commits[cur] = (tree, parents, ctime,
+                                1 + max((get_generation(parent) for parent in parents), default=0))
+                stack.pop()
+
+    # tables of the commits, the parents outside of them are looked up in layers
+    def __serialize(self, commits, layers):
+        nbase = sum(layer.count for layer in layers)
+        sha1s = sorted(commits.keys())
+        positions = {sha1: nbase + pos for pos, sha1 in enumerate(sha1s)}
+
+        def get_position(sha1):
+            if sha1 in positions:
+                return positions[sha1]
+            pos = self.__find(sha1, layers)
+            assert pos is not None, f"parent {sha1} is missing from the commit-graph"
+            return pos
+
+        records = []
+        extras = []
+        for sha1 in sha1s:
+            tree, parents, ctime, generation = commits[sha1]
+            parent1 = get_position(parents[0]) if len(parents) > 0 else self.__no_parent
+            if len(parents) <= 2:
+                parent2 = get_position(parents[1]) if len(parents) == 2 else self.__no_parent
+            else:
+                parent2 = self.__extra_flag | len(extras)
+                extras.extend(get_position(parent) for parent in parents[1:])
+                extras[-1] |= self.__extra_flag
+            records.append(self.__record.pack(tree.encode(), parent1, parent2, generation, ctime))
+
+        if len(layers) == 0:
+            header = self.__header.pack(self.__magic, self.__version, len(sha1s), len(extras))
+        else:
+            header = self.__layer_header.pack(self.__layer_magic, self.__version, len(sha1s),
+                                              len(extras), nbase)
+        data = b"".join([header] + [sha1.encode() for sha1 in sha1s] + records +
+                        [self.__extra.pack(extra) for extra in extras])
+        return data + hashlib.sha1(data).hexdigest().encode()
+
+    # the layers are dropped once the base file holds all of their commits
+    def __write_base(self, commits):
+        with LockFile(self.__path) as lock:
+            lock.write(self.__serialize(commits, []))
+            lock.commit()
+        if os.path.exists(self.__chain_path):
+            os.unlink(self.__chain_path)
+        self.__remove_unused_layers([])
+        self.__load()
+
+    # a layer is named after its checksum
+    def __write_layer(self, commits, layers):
+        data = self.__serialize(commits, layers)
+        name = data[-self.__checksum_len:].decode()
+        with LockFile(self.__get_layer_path(name)) as lock:
+            lock.write(data)
+            lock.commit()
+        return name
+
+    def __remove_unused_layers(self, names):
+        names = set(names)
+        for filename in os.listdir(self.__layers_dir):
+            if filename.startswith("graph-") and filename.endswith(".graph") and \
+                    filename[len("graph-"):-len(".graph")] not in names:
+                os.unlink(os.path.join(self.__layers_dir, filename))
@@ -1,5 +1,7 @@
 import os
+import sys
 import stat
+import heapq
 import subprocess
 
 from collections import namedtuple
@@ -10,12 +12,16 @@ from Commit import Commit
 from Tree import Tree
 from Object import Object
 from Ref import Head, Branch, Tag
+from CommitGraph import CommitGraph
+from ChangedPaths import ChangedPaths
 
 
 class Commitor():
     __instance = None
     __init = False
 
+    __max_generation = 0xFFFFFFFF
+
     def __new__(cls, *args, **kwargs):
         if cls.__instance == None:
             cls.__instance = object.__new__(cls)
@@ -30,9 +36,11 @@ class Commitor():
         self.__head = Head(repo_path)
 
     def commit(self, index, msg):
-        root = self.__build_tree(index.get_ientries())
+        root = self.__build_tree(index.get_paths())
 
-        sha1 = self.__write_tree(root)
+        sha1 = self.__write_tree(index, root, "")
+        # persist the tree sha1s recorded in the cache tree
+        index.write_index()
         commit = Commit(sha1, [self.__head.get_sha1()] if len(
             self.__head.get_sha1()) == 20 else [], msg)
 
@@ -40,54 +48,70 @@ class Commitor():
         sha1 = obj.hash_object()
         print(f"commited to master {sha1}")
         self.__head.move_with_branch(sha1)
+        CommitGraph(self.__repo_path).update([sha1])
+        changed_paths = ChangedPaths(self.__repo_path)
+        if changed_paths.exists():
+            changed_paths.add([sha1], must_lock=False)
 
-    def __build_tree(self, ientries):
+    def __build_tree(self, ipaths):
         root_node = dict()
         cur_node = root_node
-        for entry in ientries:
-            paths = entry.getpath().split(os.path.sep)
+        for ipath in ipaths:
+            paths = ipath.split(os.path.sep)
             for path in paths[:-1]:
                 if path not in cur_node:
                     # print("add dir", path)
                     cur_node[path] = {}
                 cur_node = cur_node[path]
             # print("add entry", paths[-1])
-            cur_node[paths[-1]] = entry
+            cur_node[paths[-1]] = ipath
             cur_node = root_node
 
         return root_node
 
-    def __write_tree(self, node):
+    # dirs whose tree is still valid in the index's cache tree are neither rebuilt nor rehashed
+    def __write_tree(self, index, node, dirpath):
+        sha1 = index.get_cache_tree(dirpath)
+        if sha1 is not None:
+            return sha1
+
         tree = Tree()
         for path, node in node.items():
             # print(path, isinstance(node, dict))
             if (isinstance(node, dict)):
                 # print("visit dir path", path, "goto ", node)
-                sha1 = self.__write_tree(node)
+                sha1 = self.__write_tree(
+                    index, node, os.path.join(dirpath, path))
                 tree.add_tentry(stat.S_IFDIR, path, sha1)
                 # print(f"leave dir {path}")
             else:
                 # print("visit leaf path", path)
-                tree.add_tentry(node.getmode(),
-                                path, node.getsha1())
+                ientry = index.get_ientry(node)
+                tree.add_tentry(ientry.getmode(),
+                                path, ientry.getsha1())
         # print(tree)
         obj = Object(tree, self.__repo_path)
         sha1 = obj.hash_object()
+        index.set_cache_tree(dirpath, sha1)
         return sha1
 
-    def read_tree(self, commit):
+    # trees: if given, filled with dir path -> tree sha1 of every tree visited
+    def read_tree(self, commit, trees=None):
         tree = Object(commit.get_tree_sha1(), self.__repo_path).getrawobj()
-        return self.__read_tree(tree, "")
+        if trees is not None:
+            trees[""] = commit.get_tree_sha1()
+        return self.__read_tree(tree, "", trees)
 
-    def __read_tree(self, tree, path):
+    def __read_tree(self, tree, path, trees=None):
         tentries = set()
-        for tentry in tree.get_tentries():
+        for tentry in tree.iter_tentries():
             if (stat.S_ISDIR(tentry.getmode())):
+                subpath = os.path.join(path, tentry.getpath())
+                if trees is not None:
+                    trees[subpath] = tentry.getsha1()
                 tree = Object(tentry.getsha1(), self.__repo_path).getrawobj()
                 tentries.update(
-                    self.__read_tree(
-                        tree, os.path.join(path, tentry.getpath())
-                    )
+                    self.__read_tree(tree, subpath, trees)
                 )
             else:
                 tentries.add(
@@ -99,67 +123,180 @@ class Commitor():
                 )
         return tentries
 
-    def log(self):
-        brhes = Branch.get_branches(self.__repo_path)
-        tags = Tag.get_tags(self.__repo_path)
-
-        curbrh_sha1 = self.__head.get_sha1()
+    # commits reachable from include but not from exclude, newest generation first. the parents of a
+    # commit are only queued once all its descendants are out, so exclusion marks are always complete
+    def walk(self, include, exclude=(), since=None):
+        graph = CommitGraph(self.__repo_path)
+        exclude = list(exclude)
+        heap = []
+        queued, popped, uninteresting = set(), set(), set()
+        # interesting commits still in the heap, the walk is over when there are none left
+        ninteresting = 0
+        # generations of the commits missing from the graph
+        generations = dict()
 
-        out = ""
-        brh_msg = f"{ColorEscape.cyan}HEAD"
-        tag_msg = ""
-        if self.__head.is_ref_branch():
-            brh_msg += f" -> {ColorEscape.cyan2}{self.__head.get_name()}"
-            brhes.pop(self.__head.get_name())
+        # the exclusion marks are only complete in generation order, so with exclusions the commits
+        # missing from the graph get theirs computed, times can't be trusted for that. without them
+        # any order is correct and the walk needn't read the whole history before the first commit
+        def get_generation(sha1):
+            generation = graph.get_generation(sha1)
+            if generation is not None:
+                return generation
+            if len(exclude) == 0:
+                return self.__max_generation
+            return self.__compute_generation(graph, sha1, generations)
 
-        while True:
-            obj = Object(curbrh_sha1, self.__repo_path)
-            assert obj.iscommit(), "not a commit..."
-            commit = obj.getrawobj()
-
-            parent_sha1s = commit.get_parent_sha1s()
-            assert len(parent_sha1s) == 1 or len(
-                parent_sha1s) == 0, "only support a linear commit history..."
-
-            for name, sha1 in brhes.copy().items():
-                if sha1 == curbrh_sha1:
-                    brh_msg += f", {name}"
-                    brhes.pop(name)
-            brh_msg = brh_msg.strip(" ,")
-
-            for name, sha1 in tags.copy().items():
-                if sha1 == curbrh_sha1:
-                    tag_msg += f", tag: {name}"
-                    tags.pop(name)
-            tag_msg = tag_msg.strip(" ,")
-
-            msg = ""
-            if len(brh_msg + tag_msg) != 0:
-                msg = f"{ColorEscape.orange}("
-                if len(brh_msg) != 0:
-                    msg += f"{ColorEscape.cyan2}{brh_msg}"
-                    if len(tag_msg) != 0:
-                        msg += ", "
-
-                if len(tag_msg) != 0:
-                    msg += f"{ColorEscape.orange1}{tag_msg}"
-                msg += f"{ColorEscape.orange})"
-
-            commit_msg = f"* {ColorEscape.orange}commit {curbrh_sha1} " + msg + "\n" + \
-                str(commit) + "\n"
-            if len(parent_sha1s) == 0:
-                out += textwrap.indent(commit_msg,
-                                       "  ", lambda line: line[0] != "*")
-                break
+        def push(sha1, excluded):
+            nonlocal ninteresting
+            if sha1 in queued:
+                if excluded and sha1 not in uninteresting:
+                    uninteresting.add(sha1)
+                    if sha1 not in popped:
+                        ninteresting -= 1
+                return
+            queued.add(sha1)
+            if excluded:
+                uninteresting.add(sha1)
             else:
-                out += textwrap.indent(commit_msg,
-                                       f"{ColorEscape.red}| {ColorEscape.white}", lambda line: line[0] != "*")
+                ninteresting += 1
+            heapq.heappush(heap, (-get_generation(sha1), -graph.get_time(sha1), sha1))
+
+        for sha1 in exclude:
+            push(sha1, True)
+        for sha1 in include:
+            push(sha1, False)
+
+        while ninteresting > 0:
+            _, neg_time, sha1 = heapq.heappop(heap)
+            popped.add(sha1)
+            excluded = sha1 in uninteresting
+            if not excluded:
+                ninteresting -= 1
+                # older commits and their history are cut off
+                if since is not None and -neg_time < since:
+                    continue
+                yield sha1
+            for parent in graph.get_parent_sha1s(sha1):
+                push(parent, excluded)
+
+    # 1 + the max generation of the parents, memoized in generations for the commits missing from the graph
+    def __compute_generation(self, graph, sha1, generations):
+        def get_generation(sha1):
+            return generations[sha1] if sha1 in generations else graph.get_generation(sha1)
+
+        stack = [sha1]
+        while len(stack) != 0:
+            cur = stack[-1]
+            if cur in generations:
+                stack.pop()
+                continue
+            parents = graph.get_parent_sha1s(cur)
+            pending = [parent for parent in parents if get_generation(parent) is None]
+            if len(pending) != 0:
+                stack.extend(pending)
+                continue
+            generations[cur] = 1 + max((get_generation(parent) for parent in parents), default=0)
+            stack.pop()
+        return generations[sha1]
 
-                curbrh_sha1 = parent_sha1s[0]
-                out += f"{ColorEscape.red}|\n{ColorEscape.red}|\n"
+    # stream the formatted commits to the pager as they are walked
+    # paths: if given, only the commits changing one of them (against their first parent) are shown
+    def log(self, include, exclude=(), max_count=None, since=None, oneline=False, paths=None):
+        decorations = self.__decorations()
+        commits = self.walk(include, exclude, since)
+        if paths:
+            commits = (sha1 for sha1 in commits if self.__changes_paths(sha1, paths))
 
-            brh_msg = ""
-            tag_msg = ""
+        pager = None
+        out = sys.stdout
+        if sys.stdout.isatty():
+            pager = subprocess.Popen("less -R", shell=True, stdin=subprocess.PIPE, text=True)
+            out = pager.stdin
+
+        try:
+            for count, sha1 in enumerate(commits):
+                if max_count is not None and count >= max_count:
+                    break
+                commit = Object(sha1, self.__repo_path).getrawobj()
+                if oneline:
+                    msg = commit.get_msg().splitlines()
+                    out.write(f"{ColorEscape.orange}{sha1} {decorations.get(sha1, '')}"
+                              f"{ColorEscape.white}{msg[0] if len(msg) != 0 else ''}\n")
+                else:
+                    out.write(self.__format_commit(sha1, commit, decorations.get(sha1, "")))
+                out.flush()
+        except BrokenPipeError:
+            pass
+        finally:
+            if pager is not None:
+                try:
+                    pager.stdin.close()
+                except BrokenPipeError:
+                    pass
+                pager.wait()
+
+    # the bloom filters rule out most commits, the others compare the entries of path in the trees
+    def __changes_paths(self, sha1, paths):
+        graph = CommitGraph(self.__repo_path)
+        changed_paths = ChangedPaths(self.__repo_path)
+        parents = graph.get_parent_sha1s(sha1)
+        for path in paths:
+            if changed_paths.maybe_changed(sha1, path) is False:
+                continue
+            old_tree = graph.get_tree_sha1(parents[0]) if len(parents) != 0 else None
+            if self.__path_sha1(old_tree, path) != self.__path_sha1(graph.get_tree_sha1(sha1), path):
+                return True
+        return False
+
+    # sha1 of the blob or tree at path in the tree tree_sha1, None if there is none
+    def __path_sha1(self, tree_sha1, path):
+        sha1 = tree_sha1
+        for name in path.split(os.path.sep):
+            if sha1 is None:
+                return None
+            obj = Object(sha1, self.__repo_path)
+            if not obj.istree():
+                return None
+            tentry = obj.getrawobj().get_tentry(name)
+            sha1 = tentry.getsha1() if tentry is not None else None
+        return sha1
+
+    def __format_commit(self, sha1, commit, decoration):
+        commit_msg = f"* {ColorEscape.orange}commit {sha1} " + decoration + "\n" + \
+            str(commit) + "\n"
+        if len(commit.get_parent_sha1s()) == 0:
+            return textwrap.indent(commit_msg, "  ", lambda line: line[0] != "*")
+        return textwrap.indent(commit_msg, f"{ColorEscape.red}| {ColorEscape.white}",
+                               lambda line: line[0] != "*") + \
+            f"{ColorEscape.red}|\n{ColorEscape.red}|\n"
+
+    # sha1 -> "(HEAD -> branch, branch, tag: tag) " of every commit with refs
+    def __decorations(self):
+        brhes = Branch.get_branches(self.__repo_path)
+        tags = Tag.get_tags(self.__repo_path)
+
+        brh_names = dict()
+        if self.__head.is_ref_branch():
+            brhes.pop(self.__head.get_name())
+            brh_names[self.__head.get_sha1()] = [
+                f"{ColorEscape.cyan}HEAD -> {ColorEscape.cyan2}{self.__head.get_name()}"]
+        elif self.__head.get_sha1() != "":
+            brh_names[self.__head.get_sha1()] = [f"{ColorEscape.cyan}HEAD{ColorEscape.cyan2}"]
+        for name, sha1 in brhes.items():
+            brh_names.setdefault(sha1, []).append(name)
+        tag_names = dict()
+        for name, sha1 in tags.items():
+            tag_names.setdefault(sha1, []).append(f"tag: {name}")
 
-        pless = subprocess.Popen("less", shell=True, stdin=subprocess.PIPE)
-        pless.communicate(input=out.encode())
+        decorations = dict()
+        for sha1 in brh_names.keys() | tag_names.keys():
+            msg = f"{ColorEscape.orange}("
+            if sha1 in brh_names:
+                msg += f"{ColorEscape.cyan2}" + ", ".join(brh_names[sha1])
+                if sha1 in tag_names:
+                    msg += ", "
+            if sha1 in tag_names:
+                msg += f"{ColorEscape.orange1}" + ", ".join(tag_names[sha1])
+            msg += f"{ColorEscape.orange}) "
+            decorations[sha1] = msg
+        return decorations
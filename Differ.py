@@ -0,0 +1,119 @@
+import os
+import stat
+import bisect
+
+from Object import Object
+
+
+# compare trees by walking them in lockstep, any subtree with the same sha1 on both sides is skipped.
+# every diff returns (fchanged, fcreate, fdelete): {path: (old sha1, new sha1)}, {path: new sha1}, {path: old sha1}
+class Differ():
+    __instance = None
+    __init = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+
+    # tree sha1s may be None for an empty tree
+    def diff_trees(self, old_sha1, new_sha1):
+        fchanged, fcreate, fdelete = dict(), dict(), dict()
+        self.__diff_trees(old_sha1, new_sha1, "", fchanged, fcreate, fdelete)
+        return fchanged, fcreate, fdelete
+
+    def __diff_trees(self, old_sha1, new_sha1, prefix, fchanged, fcreate, fdelete):
+        if old_sha1 == new_sha1:
+            return
+
+        old_files, old_dirs = self.__read_tree(old_sha1)
+        new_files, new_dirs = self.__read_tree(new_sha1)
+
+        for name in sorted(old_dirs.keys() | new_dirs.keys()):
+            self.__diff_trees(old_dirs.get(name), new_dirs.get(name), os.path.join(prefix, name),
+                              fchanged, fcreate, fdelete)
+
+        for name in sorted(old_files.keys() | new_files.keys()):
+            path = os.path.join(prefix, name)
+            old_file, new_file = old_files.get(name), new_files.get(name)
+            if old_file is None:
+                fcreate[path] = new_file
+            elif new_file is None:
+                fdelete[path] = old_file
+            elif old_file != new_file:
+                fchanged[path] = (old_file, new_file)
+
+    # old: the tree, new: the index. the cache tree of the index tells which subtrees are unchanged.
+    # with seed, the subtrees found unchanged are added to the cache tree
+    def diff_index_tree(self, index, tree_sha1, seed=False):
+        fchanged, fcreate, fdelete = dict(), dict(), dict()
+        paths = sorted(index.get_paths())
+        self.__diff_index_tree(index, paths, 0, len(paths), tree_sha1, "",
+                               fchanged, fcreate, fdelete, seed)
+        return fchanged, fcreate, fdelete
+
+    # paths[lo:hi] are all the index paths under the dir prefix
+    def __diff_index_tree(self, index, paths, lo, hi, tree_sha1, prefix, fchanged, fcreate, fdelete,
+                          seed=False):
+        if tree_sha1 is not None and index.get_cache_tree(prefix) == tree_sha1:
+            return
+        ndiffs = len(fchanged) + len(fcreate) + len(fdelete)
+
+        # group the index paths by their first name under prefix, a dir's paths are contiguous
+        index_files, index_dirs = dict(), dict()
+        start = len(prefix) + 1 if prefix != "" else 0
+        i = lo
+        while i < hi:
+            name, sep, _ = paths[i][start:].partition(os.path.sep)
+            if sep == "":
+                index_files[name] = paths[i]
+                i += 1
+            else:
+                # "0" is the character right after the path separator "/"
+                j = bisect.bisect_left(
+                    paths, paths[i][:start] + name + "0", i, hi)
+                index_dirs[name] = (i, j)
+                i = j
+
+        tree_files, tree_dirs = self.__read_tree(tree_sha1)
+
+        for name in sorted(index_dirs.keys() | tree_dirs.keys()):
+            dlo, dhi = index_dirs.get(name, (lo, lo))
+            self.__diff_index_tree(index, paths, dlo, dhi, tree_dirs.get(name), os.path.join(prefix, name),
+                                   fchanged, fcreate, fdelete, seed)
+
+        for name in sorted(index_files.keys() | tree_files.keys()):
+            path = os.path.join(prefix, name)
+            tree_file = tree_files.get(name)
+            index_file = index.get_ientry(index_files[name]).getsha1() \
+                if name in index_files else None
+            if tree_file is None:
+                fcreate[path] = index_file
+            elif index_file is None:
+                fdelete[path] = tree_file
+            elif tree_file != index_file:
+                fchanged[path] = (tree_file, index_file)
+
+        if seed and tree_sha1 is not None and len(fchanged) + len(fcreate) + len(fdelete) == ndiffs:
+            index.set_cache_tree(prefix, tree_sha1)
+
+    # ({name: blob sha1}, {name: tree sha1}) of a tree
+    def __read_tree(self, tree_sha1):
+        files, dirs = dict(), dict()
+        if tree_sha1 is None:
+            return files, dirs
+
+        tree = Object(tree_sha1, self.__repo_path).getrawobj()
+        for tentry in tree.iter_tentries():
+            if stat.S_ISDIR(tentry.getmode()):
+                dirs[tentry.getpath()] = tentry.getsha1()
+            else:
+                files[tentry.getpath()] = tentry.getsha1()
+        return files, dirs
@@ -0,0 +1,261 @@
+import os
+import stat
+import time
+import ctypes
+import socket
+import struct
+import selectors
+
+
+# a long running process recording the paths changed in the working tree. a client passes the token of
+# its last query and gets back a new token and the paths changed since then, or None if the daemon can't
+# tell (it was restarted or lost events), in which case the client has to check everything.
+# tokens are "<epoch>:<seq>", the epoch changes whenever the recorded history becomes incomplete
+class FsMonitor():
+    __instance = None
+    __init = False
+
+    __sock_name = "fsmonitor.sock"
+
+    # inotify events of the working tree, only used on linux
+    class Inotify():
+        IN_MODIFY = 0x00000002
+        IN_ATTRIB = 0x00000004
+        IN_CLOSE_WRITE = 0x00000008
+        IN_MOVED_FROM = 0x00000040
+        IN_MOVED_TO = 0x00000080
+        IN_CREATE = 0x00000100
+        IN_DELETE = 0x00000200
+        IN_DELETE_SELF = 0x00000400
+        IN_MOVE_SELF = 0x00000800
+        IN_Q_OVERFLOW = 0x00004000
+        IN_IGNORED = 0x00008000
+        IN_ONLYDIR = 0x01000000
+        IN_ISDIR = 0x40000000
+        IN_NONBLOCK = 0o4000
+        IN_CLOEXEC = 0o2000000
+
+        __mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+        __event_len = struct.calcsize("iIII")
+
+        def __init__(self, repo_path):
+            self.__repo_path = repo_path
+            self.__libc = ctypes.CDLL(None, use_errno=True)
+            self.__fd = self.__libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            assert self.__fd >= 0, f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}"
+            # watch descriptor -> dir path relative to the repository
+            self.__wds = dict()
+            self.__watch_tree("")
+
+        def fileno(self):
+            return self.__fd
+
+        def __watch_tree(self, dirpath):
+            changed = []
+            for root, dirs, files in os.walk(os.path.join(self.__repo_path, dirpath)):
+                relroot = os.path.relpath(root, self.__repo_path)
+                relroot = "" if relroot == "." else relroot
+                if relroot == "":
+                    dirs[:] = [d for d in dirs if d != ".git"]
+                wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(root), self.__mask)
+                if wd >= 0:
+                    self.__wds[wd] = relroot
+                changed.extend(os.path.join(relroot, name) for name in dirs + files)
+            return changed
+
+        # paths changed since the last call, None if events were lost
+        def read_changes(self):
+            changed = []
+            while True:
+                try:
+                    data = os.read(self.__fd, 1 << 16)
+                except BlockingIOError:
+                    return changed
+
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_len = struct.unpack_from("iIII", data, offset)
+                    offset += self.__event_len
+                    name = data[offset:offset + name_len].rstrip(b"\x00")
+                    offset += name_len
+
+                    if mask & self.IN_Q_OVERFLOW:
+                        return None
+                    if mask & self.IN_IGNORED:
+                        self.__wds.pop(wd, None)
+                        continue
+                    dirpath = self.__wds.get(wd)
+                    if dirpath is None or name == b"":
+                        continue
+                    path = os.path.join(dirpath, os.fsdecode(name))
+                    if path == ".git":
+                        continue
+                    changed.append(path)
+                    # the files of a dir created or moved in were never seen by a watch
+                    if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        changed.extend(self.__watch_tree(path))
+
+    # stand-in where inotify isn't available: the tree is compared with its last stat snapshot
+    class Poller():
+        def __init__(self, repo_path):
+            self.__repo_path = repo_path
+            self.__snapshot = self.__scan()
+
+        def fileno(self):
+            return None
+
+        def __scan(self):
+            snapshot = dict()
+            for root, dirs, files in os.walk(self.__repo_path):
+                relroot = os.path.relpath(root, self.__repo_path)
+                relroot = "" if relroot == "." else relroot
+                if relroot == "":
+                    dirs[:] = [d for d in dirs if d != ".git"]
+                for name in dirs + files:
+                    path = os.path.join(relroot, name)
+                    try:
+                        fstat = os.lstat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (fstat.st_mtime_ns, fstat.st_ctime_ns, fstat.st_size, fstat.st_ino)
+            return snapshot
+
+        def read_changes(self):
+            snapshot = self.__scan()
+            changed = [path for path in snapshot.keys() | self.__snapshot.keys()
+                       if snapshot.get(path) != self.__snapshot.get(path)]
+            self.__snapshot = snapshot
+            return changed
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        self.__sock_path = os.path.join(repo_path, ".git", self.__sock_name)
+
+        # daemon state: path -> seq of its last change
+        self.__epoch = None
+        self.__seq = 0
+        self.__changed = dict()
+
+    def run(self, poll=False):
+        watcher = None
+        if not poll:
+            try:
+                watcher = self.Inotify(self.__repo_path)
+            except (OSError, AttributeError, AssertionError):
+                watcher = None
+        if watcher is None:
+            watcher = self.Poller(self.__repo_path)
+        self.__reset_history()
+
+        if os.path.exists(self.__sock_path):
+            os.unlink(self.__sock_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.__sock_path)
+        server.listen()
+
+        sel = selectors.DefaultSelector()
+        sel.register(server, selectors.EVENT_READ)
+        if watcher.fileno() is not None:
+            sel.register(watcher.fileno(), selectors.EVENT_READ)
+
+        try:
+            running = True
+            while running:
+                for key, _ in sel.select():
+                    if key.fileobj is server:
+                        conn, _ = server.accept()
+                        with conn:
+                            # the events queued before the query must be part of the answer
+                            self.__record(watcher.read_changes())
+                            running = self.__serve(conn)
+                    else:
+                        self.__record(watcher.read_changes())
+        finally:
+            sel.close()
+            server.close()
+            if os.path.exists(self.__sock_path):
+                os.unlink(self.__sock_path)
+
+    def __reset_history(self):
+        self.__epoch = str(time.time_ns())
+        self.__seq = 0
+        self.__changed = dict()
+
+    def __record(self, changed):
+        if changed is None:
+            self.__reset_history()
+            return
+        if len(changed) == 0:
+            return
+        self.__seq += 1
+        for path in changed:
+            self.__changed[path] = self.__seq
+
+    # request: "query <token>\n" or "stop\n", reply: token | \n | (path | \x00)... or "*" if unknown
+    def __serve(self, conn):
+        request = b""
+        while not request.endswith(b"\n"):
+            data = conn.recv(4096)
+            if data == b"":
+                return True
+            request += data
+        request = request.decode().strip()
+        if request == "stop":
+            conn.sendall(b"stopped\n")
+            return False
+
+        _, _, token = request.partition(" ")
+        epoch, _, seq = token.partition(":")
+        reply = [f"{self.__epoch}:{self.__seq}\n".encode()]
+        if epoch != self.__epoch or not seq.isdigit():
+            reply.append(b"*")
+        else:
+            since = int(seq)
+            reply.extend(path.encode() + b"\x00"
+                         for path, pseq in self.__changed.items() if pseq > since)
+        conn.sendall(b"".join(reply))
+        return True
+
+    def __request(self, request):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.__sock_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            client.close()
+            return None
+        with client:
+            client.sendall(request.encode() + b"\n")
+            client.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                data = client.recv(1 << 16)
+                if data == b"":
+                    break
+                chunks.append(data)
+        return b"".join(chunks)
+
+    # (new token, set of changed paths or None if everything has to be checked), (None, None) without a daemon
+    def query(self, token):
+        reply = self.__request(f"query {token or ''}")
+        if not reply:
+            return None, None
+        token, _, data = reply.partition(b"\n")
+        if data == b"*":
+            return token.decode(), None
+        return token.decode(), {path.decode() for path in data.split(b"\x00") if path != b""}
+
+    def stop(self):
+        return self.__request("stop") is not None
+
+    def is_running(self):
+        return self.query(None)[0] is not None
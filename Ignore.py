@@ -0,0 +1,181 @@
+import os
+import re
+
+
+# .gitignore and .git/info/exclude rules. the rules of each file are compiled once into a single regex,
+# one named group per rule in reversed order so that the first matching alternative is the last rule
+class Ignore():
+    __instance = None
+    __init = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        self.__exclude_path = os.path.join(repo_path, ".git", "info", "exclude")
+        # dir path -> (matcher of files, matcher of dirs) of its .gitignore, None when it has no rules
+        self.__matchers = dict()
+        # dir path -> whether the dir itself or one of its parents is ignored
+        self.__ignored_dirs = {"": False}
+
+    # path is relative to the repository
+    def is_ignored(self, path, isdir=False):
+        dirpath = os.path.dirname(path)
+        if self.__is_ignored_dir(dirpath):
+            return True
+        return self.__match(path, isdir)
+
+    def __is_ignored_dir(self, dirpath):
+        ignored = self.__ignored_dirs.get(dirpath)
+        if ignored is None:
+            ignored = self.__is_ignored_dir(os.path.dirname(dirpath)) or self.__match(dirpath, True)
+            self.__ignored_dirs[dirpath] = ignored
+        return ignored
+
+    # the deepest .gitignore with a matching rule decides, info/exclude comes last
+    def __match(self, path, isdir):
+        dirpath = path
+        while dirpath != "":
+            dirpath = os.path.dirname(dirpath)
+            matcher = self.__get_matcher(dirpath)
+            if matcher is None:
+                continue
+            relpath = path[len(dirpath) + 1:] if dirpath != "" else path
+            ignored = self.__match_rules(matcher[isdir], relpath)
+            if ignored is not None:
+                return ignored
+
+        matcher = self.__get_matcher(None)
+        if matcher is not None:
+            ignored = self.__match_rules(matcher[isdir], path)
+            if ignored is not None:
+                return ignored
+        return False
+
+    # True if ignored, False if re-included by a negated rule, None if no rule matches
+    def __match_rules(self, rules, path):
+        regex, negated = rules
+        if regex is None:
+            return None
+        m = regex.fullmatch(path)
+        if m is None:
+            return None
+        return not negated[m.lastgroup]
+
+    # dirpath None is for info/exclude
+    def __get_matcher(self, dirpath):
+        if dirpath in self.__matchers:
+            return self.__matchers[dirpath]
+
+        if dirpath is None:
+            path = self.__exclude_path
+        else:
+            path = os.path.join(self.__repo_path, dirpath, ".gitignore")
+        matcher = None
+        if os.path.isfile(path):
+            with open(path, "r", errors="replace") as f:
+                matcher = self.compile(f.read().splitlines())
+        self.__matchers[dirpath] = matcher
+        return matcher
+
+    # (file rules, dir rules), each one is (regex, {group name: negated}). rules ending
+    # with "/" only match dirs
+    @classmethod
+    def compile(cls, lines):
+        rules = []
+        for line in lines:
+            rule = cls.__parse_rule(line)
+            if rule is not None:
+                rules.append(rule)
+        if len(rules) == 0:
+            return None
+
+        return (cls.__compile_rules([rule for rule in rules if not rule[2]]),
+                cls.__compile_rules(rules))
+
+    @classmethod
+    def __compile_rules(cls, rules):
+        if len(rules) == 0:
+            return None, dict()
+        groups = []
+        negated = dict()
+        for i in reversed(range(len(rules))):
+            pattern, negate, _ = rules[i]
+            groups.append(f"(?P<r{i}>{pattern})")
+            negated[f"r{i}"] = negate
+        return re.compile("|".join(groups), re.DOTALL), negated
+
+    # (regex pattern, negated, dir only) of a line, None for blank lines and comments
+    @classmethod
+    def __parse_rule(cls, line):
+        # trailing spaces are dropped unless escaped
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        line = stripped
+        if line == "" or line.startswith("#"):
+            return None
+
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        dironly = line.endswith("/")
+        line = line.rstrip("/")
+        if line == "":
+            return None
+
+        # a pattern with a slash in it is relative to the dir of the .gitignore,
+        # otherwise it matches a name at any depth
+        anchored = "/" in line
+        line = line.lstrip("/")
+        pattern = cls.__translate(line)
+        if not anchored:
+            pattern = "(?:.*/)?" + pattern
+        return pattern, negate, dironly
+
+    @classmethod
+    def __translate(cls, glob):
+        out = []
+        i, n = 0, len(glob)
+        while i < n:
+            c = glob[i]
+            if glob.startswith("**/", i) and (i == 0 or glob[i - 1] == "/"):
+                out.append("(?:.*/)?")
+                i += 3
+            elif glob.startswith("**", i) and i + 2 == n and (i == 0 or glob[i - 1] == "/"):
+                out.append(".*")
+                i += 2
+            elif c == "*":
+                out.append("[^/]*")
+                i += 1
+            elif c == "?":
+                out.append("[^/]")
+                i += 1
+            elif c == "\\" and i + 1 < n:
+                out.append(re.escape(glob[i + 1]))
+                i += 2
+            elif c == "[":
+                j = glob.find("]", i + 2)
+                if j < 0:
+                    out.append(re.escape(c))
+                    i += 1
+                    continue
+                chars = glob[i + 1:j]
+                if chars[0] in "!^":
+                    chars = "^" + chars[1:]
+                out.append("[" + chars.replace("\\", "\\\\") + "]")
+                i = j + 1
+            else:
+                out.append(re.escape(c))
+                i += 1
+        return "".join(out)
@@ -2,31 +2,50 @@ import os
 
 from collections import namedtuple
 import struct
+import mmap
 
 import hashlib
+import functools
 
-from utils import bread, bwrite
+from utils import bread, bwrite, parallel_map, LockFile
 from Object import Object
 from Blob import Blob
-from Commit import Commit
-from Commitor import Commitor
+
+
+# hash and store a working tree file, module level so that it can be run in a process pool
+def hash_file(path, repo_path):
+    fstat = os.stat(path)
+    return path, fstat, Object.hash_file(path, repo_path)
+
+
+# write the blob sha1 to the working tree file fpath, its dir must already exist
+def checkout_file(item, repo_path):
+    fpath, sha1 = item
+    _, _, chunks = Object.stream_object(sha1, repo_path)
+    with open(fpath, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return fpath, sha1, os.lstat(fpath)
 
 
 class Index():
     class IndexEntry():
-        def __init__(self, *args, **kwargs):
-            self.__header_len = 62
+        __slots__ = ("__ctime_s", "__ctime_ns", "__mtime_s", "__mtime_ns",
+                     "__dev", "__ino", "__mode", "__uid", "__gid", "__size",
+                     "__sha1", "__flags", "__path", "__blen")
+        __header_len = 62
 
+        def __init__(self, *args, **kwargs):
             self.__blen = 0
 
-            if (len(args)) + (len(kwargs)) >= 3:
-                self.build_from_memory(*args, **kwargs)
-            elif (len(args)) + (len(kwargs)) == 1:
+            if len(args) != 0 and isinstance(args[0], (bytes, bytearray, mmap.mmap)):
                 self.build_from_bytes(*args, **kwargs)
+            elif (len(args)) + (len(kwargs)) >= 3:
+                self.build_from_memory(*args, **kwargs)
             else:
                 assert False, "invalid construction, accepted construction parameters:\
                                     \n\t1. (ctime_s, ctime_ns, mtime_s, mtime_ns,dev, ino, mode, uid, gid,  size, sha1, flags, path)\
-                                    \n\t2. (bytes)"
+                                    \n\t2. (bytes, [offset], [path])"
 
         def build_from_memory(self, mode, sha1, path, ctime_s=0, ctime_ns=0, mtime_s=0, mtime_ns=0,
                               dev=0, ino=0, uid=0, gid=0,  size=0, flags=0):
@@ -44,48 +63,136 @@ class Index():
             self.__flags = flags
             self.__path = path
 
-        def build_from_bytes(self, idata):
-            assert len(idata) > 62, "the index entry is incomplete"
+        # decode the entry at offset in place, the path is not read from idata if it is given
+        def build_from_bytes(self, idata, offset=0, path=None):
+            assert len(idata) >= offset + self.__header_len, "the index entry is incomplete"
 
             (self.__ctime_s, self.__ctime_ns, self.__mtime_s, self.__mtime_ns,
              self.__dev, self.__ino,
              self.__mode, self.__uid, self.__gid,
              self.__size,
-             self.__sha1, self.__flags) = struct.unpack(
-                '!ffffLLLLLL20sH', idata[:62])
+             self.__sha1, self.__flags) = struct.unpack_from(
+                '!LLLLLLLLLL20sH', idata, offset)
             self.__sha1 = self.__sha1.decode()
-            idata = idata[self.__header_len:]
 
-            path_len = idata.index(b'\x00')
+            if path is not None:
+                self.__path = path
+                return
+
+            path_start = offset + self.__header_len
+            path_len = idata.find(b'\x00', path_start) - path_start
+            assert path_len >= 0, "the index entry is incomplete"
             padding_len = ((self.__header_len + path_len + 8) &
                            (~0b111)) - (self.__header_len + path_len)
-            self.__path = idata[:path_len].decode()
-
-            idata = idata[path_len + padding_len:]
+            self.__path = idata[path_start:path_start + path_len].decode()
 
             self.__blen = self.__header_len + path_len + padding_len
 
+        @classmethod
+        def getheaderlen(cls):
+            return cls.__header_len
+
         def getbytelen(self):
             if (self.__blen == 0):
                 self.__blen = len(self.serialization())
 
             return self.__blen
 
-        def serialization(self):
-            bientry = struct.pack('!ffffLLLLLL20sH',
-                                  self.__ctime_s, self.__ctime_ns, self.__mtime_s, self.__mtime_ns,
-                                  self.__dev, self.__ino,
-                                  self.__mode, self.__uid, self.__gid,
-                                  self.__size,
-                                  self.__sha1.encode(), self.__flags)
+        @classmethod
+        def get_header_mtime_ns(cls, header):
+            mtime_s, mtime_ns = struct.unpack_from("!LL", header, 8)
+            return mtime_s * 1000000000 + mtime_ns
+
+        # the header with a zero size, see write_index
+        @classmethod
+        def smudge_header(cls, header):
+            return header[:36] + b"\x00" * 4 + header[40:]
+
+        # the fixed size part of the entry, without the path
+        def serialization_header(self):
+            return struct.pack('!LLLLLLLLLL20sH',
+                               self.__ctime_s, self.__ctime_ns, self.__mtime_s, self.__mtime_ns,
+                               self.__dev, self.__ino,
+                               self.__mode, self.__uid, self.__gid,
+                               self.__size,
+                               self.__sha1.encode(), self.__flags)
 
-            # 8-byte align (padding with \x00)
-            len_align = (self.__header_len +
-                         len(self.__path.encode()) + 8) & (~0b111)
-            bientry = (bientry + self.__path.encode() + b"\x00" *
-                       (len_align - self.__header_len - len(self.__path)))
-
-            return bientry
+        def serialization(self):
+            return self.serialization_header() + Index.IndexEntry.serialization_path(self.__path)
+
+        # 8-byte align (padding with \x00)
+        @classmethod
+        def serialization_path(cls, path):
+            bpath = path.encode()
+            len_align = (cls.__header_len + len(bpath) + 8) & (~0b111)
+            return bpath + b"\x00" * (len_align - cls.__header_len - len(bpath))
+
+        # version 4: the path is compressed against the path of the previous entry, varint of the
+        # number of bytes dropped from the end of the previous path | the new suffix | \x00, no padding
+        @classmethod
+        def serialization_compressed_path(cls, path, prev_path):
+            bpath, bprev = path.encode(), prev_path.encode()
+            common = len(os.path.commonprefix([bpath, bprev]))
+            return cls.__encode_varint(len(bprev) - common) + bpath[common:] + b"\x00"
+
+        # (path, offset after it) of a compressed path at offset
+        @classmethod
+        def read_compressed_path(cls, idata, offset, prev_path):
+            ndrop, offset = cls.__decode_varint(idata, offset)
+            nul = idata.find(b"\x00", offset)
+            assert nul >= 0 and ndrop <= len(prev_path), "the index entry is incomplete"
+            return prev_path[:len(prev_path) - ndrop] + idata[offset:nul], nul + 1
+
+        # the offset encoding of git: every continuation byte adds one to the value before the shift
+        @classmethod
+        def __encode_varint(cls, n):
+            varint = bytearray([n & 0x7f])
+            n >>= 7
+            while n:
+                n -= 1
+                varint.insert(0, 0x80 | (n & 0x7f))
+                n >>= 7
+            return bytes(varint)
+
+        @classmethod
+        def __decode_varint(cls, data, offset):
+            c = data[offset]
+            n = c & 0x7f
+            while c & 0x80:
+                offset += 1
+                c = data[offset]
+                n = ((n + 1) << 7) | (c & 0x7f)
+            return n, offset + 1
+
+        # stat data is truncated to 32 bits, the same as what git stores
+        def update_stat(self, fstat):
+            self.__ctime_s = int(fstat.st_ctime) & 0xFFFFFFFF
+            self.__ctime_ns = fstat.st_ctime_ns % 1000000000
+            self.__mtime_s = int(fstat.st_mtime) & 0xFFFFFFFF
+            self.__mtime_ns = fstat.st_mtime_ns % 1000000000
+            self.__dev = fstat.st_dev & 0xFFFFFFFF
+            self.__ino = fstat.st_ino & 0xFFFFFFFF
+            self.__uid = fstat.st_uid & 0xFFFFFFFF
+            self.__gid = fstat.st_gid & 0xFFFFFFFF
+            self.__size = fstat.st_size & 0xFFFFFFFF
+
+        # a zero size recorded for a non empty blob is a smudged entry, which never matches
+        def match_stat(self, fstat):
+            if self.__size == 0 and self.__sha1 != Index.empty_blob_sha1:
+                return False
+            return (self.__mode == fstat.st_mode & 0xFFFFFFFF and
+                    self.__mtime_s == int(fstat.st_mtime) & 0xFFFFFFFF and
+                    self.__mtime_ns == fstat.st_mtime_ns % 1000000000 and
+                    self.__ctime_s == int(fstat.st_ctime) & 0xFFFFFFFF and
+                    self.__ctime_ns == fstat.st_ctime_ns % 1000000000 and
+                    self.__ino == fstat.st_ino & 0xFFFFFFFF and
+                    self.__dev == fstat.st_dev & 0xFFFFFFFF and
+                    self.__uid == fstat.st_uid & 0xFFFFFFFF and
+                    self.__gid == fstat.st_gid & 0xFFFFFFFF and
+                    self.__size == fstat.st_size & 0xFFFFFFFF)
+
+        def getmtime_ns(self):
+            return self.__mtime_s * 1000000000 + self.__mtime_ns
 
         def getpath(self):
             return self.__path
@@ -102,12 +209,18 @@ class Index():
     __instance = None
     __init = False
 
+    __versions = (2, 4)
+
+    empty_blob_sha1 = hashlib.sha1(f"{Object.ObjType.BLOB} 0\x00".encode()).hexdigest()[:20]
+
     def __new__(cls, *args, **kwargs):
         if cls.__instance == None:
             cls.__instance = object.__new__(cls)
         return cls.__instance
 
-    def __init__(self, repo_path, version):
+    # with lock, index.lock is taken before the index is read and held up to the next write, so
+    # that no one else can write the index in between (for the commands that modify it)
+    def __init__(self, repo_path, version, lock=False):
         if self.__init:
             return
         self.__init = True
@@ -117,92 +230,410 @@ class Index():
         assert os.path.exists(self.__index_path), "index doesn't exists"
 
         self.__magic = b"DIRC"
+        # the version of a new index, afterwards the one of the index file
         self.__version = version
-        assert version == 2, "only support version 2"
+        assert version in self.__versions, "only support version 2 and 4"
         self.__header_len = 12
-
-        self.__ientries = dict()
+        self.__checksum_len = 40
+        self.__ext_header_len = 8
+        self.__tree_ext = b"TREE"
+        self.__untracked_ext = b"UNTR"
+        self.__fsmonitor_ext = b"FSMN"
+
+        # the entries are kept as a table: path -> row, and the fixed size headers of all
+        # rows packed in one bytearray. IndexEntry objects are only decoded on access
+        self.__rows = dict()
+        self.__headers = bytearray()
+        # dir path ("" for the root) -> sha1 of the tree object last written for it,
+        # a dir is dropped whenever an entry under it changes (cache-tree extension)
+        self.__cache_tree = dict()
+        # dir path ("" for the root) -> (mtime of the dir, untracked file names, subdir names)
+        # when it was last listed, a dir whose mtime is unchanged needn't be listed again (untracked cache)
+        self.__untracked = dict()
+        # token of the last fsmonitor query and the paths that weren't clean at that point,
+        # all the other entries are known to match the working tree until the monitor reports them
+        self.__fsmonitor_token = None
+        self.__fsmonitor_dirty = set()
+        # mtime of the index file when it was last read or written, used to detect racily clean entries
+        self.__stamp_ns = 0
+        # (mtime, size, inode) of the index file as last read or written, a write fails if someone
+        # else replaced the file in between
+        self.__file_stamp = None
+        # the bytes of the index file last read or written, and path -> (start, end, previous path)
+        # of the entries unchanged since then, which are written again as they are. a version 4 entry
+        # can only be reused after the same previous path
+        self.__raw = None
+        self.__raw_version = version
+        self.__spans = dict()
+        # whether anything changed since the index was last read or written
+        self.__dirty = False
+        self.__lock = LockFile(self.__index_path) if lock else None
         self.read_index()
 
     def add_ientry(self, path):
-        fstat = os.stat(path)
-        data = bread(path)
-        obj = Object(Blob(data), self.__repo_path)
-        sha1 = obj.hash_object()
-
+        self.__add_hashed(*hash_file(path, self.__repo_path))
+
+    # hash the files across a pool of workers, then merge all the entries in one pass. the tracked
+    # files whose stat data matches their entry are unchanged and skipped
+    def add_ientries(self, paths, jobs=None, use_process=False):
+        paths = [path for path in paths if not self.__is_unchanged(path)]
+        results = parallel_map(functools.partial(hash_file, repo_path=self.__repo_path),
+                               paths, jobs, use_process)
+        for path, fstat, sha1 in results:
+            self.__add_hashed(path, fstat, sha1)
+
+    def __is_unchanged(self, path):
+        relpath = os.path.relpath(path, self.__repo_path)
+        if relpath not in self.__rows:
+            return False
+        ientry = self.get_ientry(relpath)
+        return ientry.match_stat(os.stat(path)) and not self.is_racy(ientry)
+
+    # add a file whose content is already known to be the blob sha1, without hashing it again
+    def add_hashed_ientry(self, path, sha1, fstat=None):
+        self.__add_hashed(path, fstat or os.stat(path), sha1)
+
+    def __add_hashed(self, path, fstat, sha1):
         # convert paths to standard relative path to the repository
         path = os.path.relpath(path, self.__repo_path)
 
-        ientry = self.IndexEntry(ctime_s=fstat.st_ctime, ctime_ns=fstat.st_ctime,
-                                 mtime_s=fstat.st_mtime, mtime_ns=fstat.st_mtime_ns,
-                                 dev=fstat.st_dev, ino=fstat.st_ino,
-                                 mode=fstat.st_mode, uid=fstat.st_uid, gid=fstat.st_gid,
-                                 size=fstat.st_size,
-                                 sha1=sha1, flags=max(len(path), 0xFFF), path=path)
-
-        self.__ientries[path] = ientry
-        sorted(self.__ientries.items())
-
+        ientry = self.IndexEntry(mode=fstat.st_mode, sha1=sha1,
+                                 flags=max(len(path), 0xFFF), path=path)
+        ientry.update_stat(fstat)
+
+        if self.__put(ientry):
+            self.invalidate_cache_tree(path)
+
+    # returns whether the entry is new or changed
+    def __put(self, ientry):
+        header_len = self.IndexEntry.getheaderlen()
+        path = ientry.getpath()
+        header = ientry.serialization_header()
+        row = self.__rows.get(path)
+        if row is None:
+            self.__rows[path] = len(self.__headers) // header_len
+            self.__headers += header
+        elif self.__headers[row * header_len:(row + 1) * header_len] != header:
+            self.__headers[row * header_len:(row + 1) * header_len] = header
+        else:
+            # re-adding an unchanged entry leaves the index clean
+            return False
+        self.__spans.pop(path, None)
+        self.__dirty = True
+        return True
+
+    def __clear(self):
+        self.__rows = dict()
+        self.__headers = bytearray()
+        self.__spans = dict()
+        self.__cache_tree = dict()
+        self.__untracked = dict()
+        self.__fsmonitor_token = None
+        self.__fsmonitor_dirty = set()
+        self.__dirty = True
+
+    # the row of a removed entry is left unused until the index is written
     def remove_ientry(self, path):
-        self.__ientries.pop(path)
+        self.__rows.pop(path)
+        self.__spans.pop(path, None)
+        self.__dirty = True
+        self.invalidate_cache_tree(path)
+        # the file becomes untracked but its dir mtime doesn't change
+        self.remove_untracked(os.path.dirname(path))
+
+    # the trees of all the dirs containing path have to be rebuilt
+    def invalidate_cache_tree(self, path):
+        dirpath = os.path.dirname(path)
+        while True:
+            if self.__cache_tree.pop(dirpath, None) is not None:
+                self.__dirty = True
+            if dirpath == "":
+                break
+            dirpath = os.path.dirname(dirpath)
+
+    def get_cache_tree(self, dirpath):
+        return self.__cache_tree.get(dirpath)
+
+    def set_cache_tree(self, dirpath, sha1):
+        if self.__cache_tree.get(dirpath) != sha1:
+            self.__cache_tree[dirpath] = sha1
+            self.__dirty = True
+
+    # (mtime ns, untracked names, subdir names) of dirpath, the names may have been added since
+    def get_untracked(self, dirpath):
+        return self.__untracked.get(dirpath)
+
+    def set_untracked(self, dirpath, mtime_ns, names, subdirs):
+        self.__untracked[dirpath] = (mtime_ns, names, subdirs)
+        self.__dirty = True
+
+    def remove_untracked(self, dirpath):
+        if self.__untracked.pop(dirpath, None) is not None:
+            self.__dirty = True
+
+    def get_fsmonitor(self):
+        return self.__fsmonitor_token, self.__fsmonitor_dirty
+
+    def set_fsmonitor(self, token, dirty):
+        self.__fsmonitor_token = token
+        self.__fsmonitor_dirty = dirty
+        self.__dirty = True
+
+    def get_ientry(self, path):
+        row = self.__rows[path]
+        return self.IndexEntry(self.__headers, row * self.IndexEntry.getheaderlen(), path)
 
     def get_ientries(self):
-        return list(self.__ientries.values())
-
-    def write_index(self):
+        return [self.get_ientry(path) for path in self.__rows]
+
+    # paths of all entries, without decoding them
+    def get_paths(self):
+        return list(self.__rows.keys())
+
+    def has_ientry(self, path):
+        return path in self.__rows
+
+    # the file content is known to be unchanged, only record its new stat data
+    def refresh_ientry(self, path, fstat):
+        ientry = self.get_ientry(path)
+        ientry.update_stat(fstat)
+        self.__put(ientry)
+
+    # an entry modified in the same time slice as the index was written may be changed
+    # again without changing its stat data, so its content must be checked (racy git)
+    def is_racy(self, ientry):
+        return self.is_racy_mtime(ientry.getmtime_ns())
+
+    def is_racy_mtime(self, mtime_ns):
+        return mtime_ns >= self.__stamp_ns
+
+    def get_version(self):
+        return self.__version
+
+    # the index is rewritten in the new version at the next write
+    def set_version(self, version):
+        assert version in self.__versions, "only support version 2 and 4"
+        if version != self.__version:
+            self.__version = version
+            self.__dirty = True
+
+    # nothing is written when the index is clean, otherwise it goes through index.lock and a rename.
+    # without must_write the write is only opportunistic, for the stat refreshes and caches of read only
+    # commands: it is skipped when the index is locked or was changed by another process, and False is
+    # returned. the changes stay in memory
+    def write_index(self, must_write=True):
         assert os.path.exists(self.__index_path), "index doesn't exist"
-
+        if not self.__dirty:
+            return True
+
+        lock = self.__lock or LockFile(self.__index_path, must_write)
+        self.__lock = None
+        with lock:
+            if not lock.islocked():
+                return False
+            if self.__get_file_stamp() != self.__file_stamp:
+                assert not must_write, "index was modified by another process, try again"
+                return False
+            idata, spans = self.__serialize_index(lock.getmtime_ns())
+            lock.write(idata)
+            lock.commit()
+
+        if isinstance(self.__raw, mmap.mmap):
+            self.__raw.close()
+        self.__raw = idata
+        self.__raw_version = self.__version
+        self.__spans = spans
+        self.__dirty = False
+        self.__file_stamp = self.__get_file_stamp()
+        self.__stamp_ns = self.__file_stamp[0]
+        return True
+
+    # drop the lock held since the read if nothing was written
+    def unlock_index(self):
+        if self.__lock is not None:
+            self.__lock.rollback()
+            self.__lock = None
+
+    # (index file bytes, spans of the entries in them)
+    # an entry modified no earlier than racy_ns (the mtime of index.lock) may be modified again in the
+    # same time slice once the index is written, with its stat data unchanged. it is smudged like git
+    # does, its size is zeroed so that its content is hashed again instead of being trusted for good
+    # after the next write
+    def __serialize_index(self, racy_ns):
+        # the headers are written as they are stored, and compacted on the way. the entries
+        # unchanged since the last read are copied from the raw bytes
+        header_len = self.IndexEntry.getheaderlen()
         bientries = []
-        for entry in self.__ientries.values():
-            bientries.append(entry.serialization())
+        rows = dict()
+        headers = bytearray()
+        spans = dict()
+        offset = self.__header_len
+        reuse = self.__raw_version == self.__version
+        compressed = self.__version == 4
+        # sorted paths share the longest prefixes with the previous ones
+        items = sorted(self.__rows.items()) if compressed else self.__rows.items()
+        prev_path = ""
+        for path, row in items:
+            header = self.__headers[row * header_len:(row + 1) * header_len]
+            span = self.__spans.get(path)
+            if self.IndexEntry.get_header_mtime_ns(header) >= racy_ns:
+                header = self.IndexEntry.smudge_header(header)
+                span = None
+            if reuse and span is not None and (not compressed or span[2] == prev_path):
+                bientry = self.__raw[span[0]:span[1]]
+            elif compressed:
+                bientry = bytes(header) + \
+                    self.IndexEntry.serialization_compressed_path(path, prev_path)
+            else:
+                bientry = bytes(header) + self.IndexEntry.serialization_path(path)
+            bientries.append(bientry)
+            spans[path] = (offset, offset + len(bientry), prev_path)
+            offset += len(bientry)
+            rows[path] = len(rows)
+            headers += header
+            prev_path = path
+        self.__rows = rows
+        self.__headers = headers
+
+        if len(self.__cache_tree) != 0:
+            bientries.append(self.__serialize_cache_tree())
+        if len(self.__untracked) != 0:
+            bientries.append(self.__serialize_untracked())
+        if self.__fsmonitor_token is not None:
+            bientries.append(self.__serialize_fsmonitor())
 
         header = struct.pack("!4sLL", self.__magic,
-                             self.__version, len(bientries))
+                             self.__version, len(rows))
         idata = header + b"".join(bientries)
-        idata = idata + hashlib.sha1(idata).hexdigest().encode()
-        bwrite(self.__index_path, idata)
+        return idata + hashlib.sha1(idata).hexdigest().encode(), spans
 
+    def __get_file_stamp(self):
+        fstat = os.stat(self.__index_path)
+        return fstat.st_mtime_ns, fstat.st_size, fstat.st_ino
+
+    # map the index file and copy the entries into the table, without decoding them
     def read_index(self):
         assert os.path.exists(self.__index_path), "index doesn't exist"
-        self.__ientries = dict()
-
-        idata = bread(self.__index_path)
-        if len(idata) == 0:
-            return
-
-        assert len(idata) > self.__header_len, "index header is imcompleted"
-        magic, version, ientry_len = struct.unpack(
-            "!4sLL", idata[:self.__header_len])
-        idata = idata[self.__header_len:]
-
+        self.__clear()
+
+        if isinstance(self.__raw, mmap.mmap):
+            self.__raw.close()
+        self.__raw = None
+        with open(self.__index_path, "rb") as f:
+            fstat = os.fstat(f.fileno())
+            self.__stamp_ns = fstat.st_mtime_ns
+            self.__file_stamp = (fstat.st_mtime_ns, fstat.st_size, fstat.st_ino)
+            self.__dirty = False
+            if fstat.st_size == 0:
+                return
+            # the map is kept to copy the unchanged entries from when writing
+            self.__raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__read_idata(self.__raw)
+            self.__dirty = False
+
+    def __read_idata(self, idata):
+        assert len(idata) > self.__header_len + \
+            self.__checksum_len, "index header is imcompleted"
+        with memoryview(idata) as view:
+            checksum = hashlib.sha1(
+                view[:-self.__checksum_len]).hexdigest().encode()
+        assert checksum == idata[-self.__checksum_len:], "index checksum error"
+
+        magic, version, ientry_len = struct.unpack_from("!4sLL", idata, 0)
         assert magic == self.__magic, "magic check error"
-        assert version == self.__version, "git version check error"
-
+        assert version in self.__versions, "git version check error"
+        self.__version = self.__raw_version = version
+
+        offset = self.__header_len
+        header_len = self.IndexEntry.getheaderlen()
+        headers = []
+        prev_bpath = b""
+        prev_path = ""
         for i in range(ientry_len):
-            ientry = self.IndexEntry(idata)
-            idata = idata[ientry.getbytelen():]
-
-            self.__ientries[ientry.getpath()] = ientry
-
-    def reset_to_commit(self, commit):
-        assert isinstance(commit, Commit), "not a commit"
-        self.__ientries = dict()
-        for tentry in Commitor(self.__repo_path).read_tree(commit):
-            path = tentry.getpath()
-            ientry = self.IndexEntry(mode=tentry.getmode(), sha1=tentry.getsha1(),
-                                     flags=max(len(path), 0xFFF), path=path)
-            self.__ientries[path] = ientry
-        sorted(self.__ientries.items())
-        self.write_index()
-
-    def get_bytedata(self, path):
-        sha1 = self.__ientries[path].getsha1()
-        obj = Object(sha1, self.__repo_path)
-        return obj.getrawobj().serialization()
+            start = offset
+            if version == 4:
+                bpath, offset = self.IndexEntry.read_compressed_path(
+                    idata, offset + header_len, prev_bpath)
+                path = bpath.decode()
+                prev_bpath = bpath
+            else:
+                path_end = idata.find(b"\x00", offset + header_len)
+                assert path_end >= 0, "the index entry is incomplete"
+                path = idata[offset + header_len:path_end].decode()
+                # entries are padded to 8 bytes relative to their own start
+                offset += (path_end - offset + 8) & (~0b111)
+            self.__rows[path] = i
+            headers.append(idata[start:start + header_len])
+            self.__spans[path] = (start, offset, prev_path)
+            prev_path = path
+        self.__headers = bytearray(b"".join(headers))
+
+        # extensions: signature | size | data, unknown ones are skipped
+        end = len(idata) - self.__checksum_len
+        while offset < end:
+            signature, size = struct.unpack_from("!4sL", idata, offset)
+            offset += self.__ext_header_len
+            assert offset + size <= end, "index extension is incompleted"
+            if signature == self.__tree_ext:
+                self.__read_cache_tree(idata[offset:offset + size])
+            elif signature == self.__untracked_ext:
+                self.__read_untracked(idata[offset:offset + size])
+            elif signature == self.__fsmonitor_ext:
+                self.__read_fsmonitor(idata[offset:offset + size])
+            offset += size
+
+    # cache-tree extension: (dir path | \x00 | sha1)...
+    def __serialize_cache_tree(self):
+        data = b"".join(dirpath.encode() + b"\x00" + sha1.encode()
+                        for dirpath, sha1 in self.__cache_tree.items())
+        return struct.pack("!4sL", self.__tree_ext, len(data)) + data
+
+    def __read_cache_tree(self, data):
+        offset = 0
+        while offset < len(data):
+            nul = data.index(b"\x00", offset)
+            sha1 = data[nul + 1:nul + 21].decode()
+            self.__cache_tree[data[offset:nul].decode()] = sha1
+            offset = nul + 21
+
+    # untracked cache extension: (dir path | \x00 | mtime | names count | subdirs count | (name | \x00)...)...
+    def __serialize_untracked(self):
+        bdirs = []
+        for dirpath, (mtime_ns, names, subdirs) in self.__untracked.items():
+            bdirs.append(dirpath.encode() + b"\x00")
+            bdirs.append(struct.pack("!QLL", mtime_ns, len(names), len(subdirs)))
+            bdirs.extend(name.encode() + b"\x00" for name in names + subdirs)
+        data = b"".join(bdirs)
+        return struct.pack("!4sL", self.__untracked_ext, len(data)) + data
+
+    def __read_untracked(self, data):
+        offset = 0
+        while offset < len(data):
+            nul = data.index(b"\x00", offset)
+            dirpath = data[offset:nul].decode()
+            mtime_ns, nnames, nsubdirs = struct.unpack_from("!QLL", data, nul + 1)
+            offset = nul + 1 + struct.calcsize("!QLL")
+            names = []
+            for _ in range(nnames + nsubdirs):
+                nul = data.index(b"\x00", offset)
+                names.append(data[offset:nul].decode())
+                offset = nul + 1
+            self.__untracked[dirpath] = (mtime_ns, names[:nnames], names[nnames:])
+
+    # fsmonitor extension: token | \x00 | (dirty path | \x00)...
+    def __serialize_fsmonitor(self):
+        data = b"".join(name.encode() + b"\x00"
+                        for name in [self.__fsmonitor_token] + sorted(self.__fsmonitor_dirty))
+        return struct.pack("!4sL", self.__fsmonitor_ext, len(data)) + data
+
+    def __read_fsmonitor(self, data):
+        names = bytes(data).split(b"\x00")[:-1]
+        self.__fsmonitor_token = names[0].decode()
+        self.__fsmonitor_dirty = {name.decode() for name in names[1:]}
 
     def __str__(self):
         out = ""
-        for ientry in self.__ientries.values():
+        for ientry in self.get_ientries():
             out += f"{ientry.getmode():o} {ientry.getsha1()} {ientry.getflags() >> 12}\t\t{ientry.getpath()}\n"
 
         return out[:-1]  # move the last '\n' char
@@ -1,17 +1,29 @@
 import os
 
+import bisect
 import enum
+import itertools
 import hashlib
+import tempfile
 import zlib
 
-from utils import bread, bwrite
+from utils import bread, bwrite, is_hexdigits
 
 from Blob import Blob
 from Tree import Tree
 from Commit import Commit
+from Pack import Pack
+from ObjectCache import ObjectCache
 
 
 class Object():
+    __hashlen = 20
+    __chunk_size = 1 << 16
+
+    # repo_path -> sorted ids of the loose objects
+    __loose_sha1s = dict()
+    # decoded objects shared by every reader in the process
+    __cache = ObjectCache()
 
     class ObjType(enum.IntEnum):
         COMMIT = 1
@@ -36,8 +48,6 @@ class Object():
         else:
             self.build_from_memory(arg)
 
-        self.__hashlen = 20
-
     def build_from_memory(self, raw_obj):
         self.__raw_obj = raw_obj
 
@@ -51,15 +61,25 @@ class Object():
         else:
             assert False, "unsupported object type"
 
+    # the decoded objects never change once read, so the same instance is shared through the cache
     def build_from_bytes(self, sha1_prefix):
+        sha1 = Object.__full_sha1(sha1_prefix, self.__repo_path)
+        key = (self.__repo_path, sha1)
+        cached = Object.__cache.get(key)
+        if cached is not None:
+            self.__type, self.__len, self.__raw_obj = cached
+            return
+
         (self.__type, self.__len, content) = Object.read_object(
-            sha1_prefix, self.__repo_path)
+            sha1, self.__repo_path)
         if self.isblob():
             self.__raw_obj = Blob(content)
         elif self.istree():
             self.__raw_obj = Tree(content)
         elif self.iscommit():
             self.__raw_obj = Commit(content)
+        Object.__cache.put(key, (self.__type, self.__len, self.__raw_obj),
+                           self.__len, self.isblob())
 
     def getlen(self):
         return len(self.__raw_obj.serialization())
@@ -80,49 +100,263 @@ class Object():
         return self.ObjType.COMMIT == self.__type
 
     def hash_object(self, write=True):
-        header = f"{self.__type} {self.getlen()}\x00".encode()
-        obj = header + self.__raw_obj.serialization()
-        sha1 = hashlib.sha1(obj).hexdigest()[:self.__hashlen]
+        content = self.__raw_obj.serialization()
+        header = f"{self.__type} {len(content)}\x00".encode()
+        hasher = hashlib.sha1(header)
+        hasher.update(content)
+        sha1 = hasher.hexdigest()[:self.__hashlen]
 
         if write:
-            obj_path = os.path.join(self.__objects_dir, sha1[:2], sha1[2:])
-            if (not os.path.exists(obj_path)):
+            if not Object.has_object(sha1, self.__repo_path):
+                Object.__store([header, content], self.__repo_path)
+
+        return sha1
+
+    # hash a file as a blob chunk by chunk, so that memory stays flat for large files. the file is
+    # only read again and deflated when the blob isn't stored yet
+    @classmethod
+    def hash_file(cls, path, repo_path, write=True):
+        size = os.stat(path).st_size
+        header = f"{cls.ObjType.BLOB} {size}\x00".encode()
+        hasher = hashlib.sha1(header)
+        for chunk in cls.__read_chunks(path, size):
+            hasher.update(chunk)
+        sha1 = hasher.hexdigest()[:cls.__hashlen]
+        if not write or cls.has_object(sha1, repo_path):
+            return sha1
+
+        stored = cls.__store(itertools.chain([header], cls.__read_chunks(path, size)), repo_path)
+        assert stored == sha1, f"{path} is changed while being hashed"
+        return sha1
+
+    @classmethod
+    def __read_chunks(cls, path, size):
+        nread = 0
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(cls.__chunk_size)
+                if not chunk:
+                    break
+                nread += len(chunk)
+                yield chunk
+        assert nread == size, f"{path} is changed while being hashed"
+
+    # write a packed object out as a loose file with the given mtime, so that gc expires it by its age
+    # once its pack is gone
+    @classmethod
+    def write_loose(cls, sha1, obj_type, content, repo_path, mtime):
+        obj_path = cls.__loose_path(sha1, repo_path)
+        if os.path.exists(obj_path):
+            return False
+        header = f"{obj_type} {len(content)}\x00".encode()
+        assert cls.__store([header, content], repo_path, loose=True) == sha1, f"object {sha1} is corrupted"
+        os.utime(obj_path, (mtime, mtime))
+        return True
+
+    # hash and deflate the chunks into a temp file, then rename it into the objects dir. with loose,
+    # only an existing loose file counts, not a packed copy
+    @classmethod
+    def __store(cls, chunks, repo_path, loose=False):
+        objects_dir = os.path.join(repo_path, ".git", "objects")
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix="tmp_obj_")
+        try:
+            hasher = hashlib.sha1()
+            compressor = zlib.compressobj()
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            sha1 = hasher.hexdigest()[:cls.__hashlen]
+
+            obj_path = os.path.join(objects_dir, sha1[:2], sha1[2:])
+            if os.path.exists(obj_path) or (not loose and cls.has_object(sha1, repo_path)):
+                os.unlink(tmp_path)
+            else:
                 os.makedirs(os.path.dirname(obj_path), exist_ok=True)
-                bwrite(obj_path, zlib.compress(obj))
+                os.replace(tmp_path, obj_path)
+                cls.__add_loose_sha1(sha1, repo_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
 
         return sha1
 
     @classmethod
     def read_object(cls, sha1_prefix, repo_path):
-        obj_file, _ = cls.find_object(sha1_prefix, repo_path)
-        data = zlib.decompress(bread(obj_file))
-        obj_type, data = data.split(b" ", maxsplit=1)
-        obj_len, obj_content = data.split(b"\x00", maxsplit=1)
-        assert int(obj_len) == len(
-            obj_content), f"the length of the content {obj_len} is inconsistent with the length property in header {len(obj_content)}, something goes wrong"
+        obj_type, obj_len, chunks = cls.stream_object(
+            cls.__full_sha1(sha1_prefix, repo_path), repo_path)
+        return obj_type, obj_len, b"".join(chunks)
 
-        return int(obj_type), int(obj_len), obj_content
+    # a full id is trusted as it is, the object is checked when it is read
+    @classmethod
+    def __full_sha1(cls, sha1_prefix, repo_path):
+        if len(sha1_prefix) == cls.__hashlen:
+            return sha1_prefix.lower()
+        return cls.resolve_sha1(sha1_prefix, repo_path)
 
     @classmethod
-    def find_object(cls, sha1_prefix, repo_path):
+    def get_cache(cls):
+        return cls.__cache
+
+    # parse the header from the first inflated chunk, the content is yielded chunk by chunk
+    @classmethod
+    def stream_object(cls, sha1_prefix, repo_path):
+        sha1 = cls.resolve_sha1(sha1_prefix, repo_path)
+        loose = cls.__open_loose(sha1, repo_path)
+        if loose is None:
+            return cls.__stream_packed(sha1, repo_path)
+        obj_type, obj_len, data, chunks = loose
+        return obj_type, obj_len, cls.__check_len(data, chunks, obj_len)
+
+    # type and length of an object, a loose object is only inflated up to its header
+    @classmethod
+    def read_header(cls, sha1_prefix, repo_path):
+        sha1 = cls.resolve_sha1(sha1_prefix, repo_path)
+        loose = cls.__open_loose(sha1, repo_path)
+        if loose is None:
+            pack, offset = cls.__find_packed(sha1, repo_path)
+            return pack.read_type_size(offset)
+        obj_type, obj_len, _, chunks = loose
+        chunks.close()
+        return obj_type, obj_len
+
+    # (type, length, content after the header, the rest of the chunks) of a loose object, None if it
+    # isn't loose. the file stays open until the chunks are exhausted or closed
+    @classmethod
+    def __open_loose(cls, sha1, repo_path):
+        obj_file = cls.__loose_path(sha1, repo_path)
+        if not os.path.exists(obj_file):
+            return None
+        chunks = cls.__inflate_chunks(obj_file)
+
+        data = b""
+        for chunk in chunks:
+            data += chunk
+            if b"\x00" in data:
+                break
+        if b"\x00" not in data:
+            chunks.close()
+            assert False, "object header is incompleted"
+        header, data = data.split(b"\x00", maxsplit=1)
+        obj_type, obj_len = header.split(b" ", maxsplit=1)
+        return int(obj_type), int(obj_len), data, chunks
+
+    @classmethod
+    def __stream_packed(cls, sha1, repo_path):
+        pack, offset = cls.__find_packed(sha1, repo_path)
+        obj_type, obj_len, chunks = pack.stream(offset)
+        return obj_type, obj_len, cls.__check_len(b"", chunks, obj_len)
+
+    @classmethod
+    def __find_packed(cls, sha1, repo_path):
+        for pack in Pack.get_packs(repo_path):
+            offset = pack.get_offset(sha1)
+            if offset is not None:
+                return pack, offset
+        assert False, f"object {sha1} doesn't exist"
+
+    @classmethod
+    def __inflate_chunks(cls, obj_file):
+        decompressor = zlib.decompressobj()
+        with open(obj_file, "rb") as f:
+            while not decompressor.eof:
+                data = decompressor.unconsumed_tail or f.read(cls.__chunk_size)
+                assert len(data) != 0, f"object {obj_file} is truncated"
+                chunk = decompressor.decompress(data, cls.__chunk_size)
+                if len(chunk) != 0:
+                    yield chunk
+
+    # a reader stopping early closes the chunks, and with them the object file
+    @classmethod
+    def __check_len(cls, data, chunks, obj_len):
+        nread = len(data)
+        try:
+            if nread != 0:
+                yield data
+            for chunk in chunks:
+                nread += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        assert obj_len == nread, f"the length of the content {nread} is inconsistent with the length property in header {obj_len}, something goes wrong"
+
+    @classmethod
+    def __loose_path(cls, sha1, repo_path):
+        return os.path.join(repo_path, ".git", "objects", sha1[:2], sha1[2:])
+
+    # a full sha1 is looked up with a stat and the pack indexes, without listing any dir
+    @classmethod
+    def has_object(cls, sha1, repo_path):
+        if os.path.exists(cls.__loose_path(sha1, repo_path)):
+            return True
+        return any(pack.get_offset(sha1) is not None for pack in Pack.get_packs(repo_path))
+
+    # full sha1 of a loose or packed object, the prefix must match exactly one object
+    @classmethod
+    def resolve_sha1(cls, sha1_prefix, repo_path):
         assert len(
             sha1_prefix) >= 2, "the length of hash number must be greater or equal to 2"
+        assert is_hexdigits(sha1_prefix), f"{sha1_prefix} is not a hash number"
+        sha1_prefix = sha1_prefix.lower()
 
-        cls.__objects_dir = os.path.join(repo_path, ".git", "objects")
+        if len(sha1_prefix) == cls.__hashlen:
+            assert cls.has_object(
+                sha1_prefix, repo_path), f"object {sha1_prefix} doesn't exist"
+            return sha1_prefix
 
-        dirname = os.path.join(cls.__objects_dir, sha1_prefix[:2])
-        assert os.path.exists(dirname), f"object dir {dirname} dosen't exists"
+        sha1s = cls.__match_sha1s(sha1_prefix, repo_path)
+        if len(sha1s) == 0:
+            # the objects may be written by another process after the ids are loaded
+            cls.forget_loose_sha1s(repo_path)
+            sha1s = cls.__match_sha1s(sha1_prefix, repo_path)
+        assert len(sha1s) != 0, f"no object matched {sha1_prefix}"
+        assert len(sha1s) == 1, f"{sha1_prefix} is ambiguous, candidates: {', '.join(sha1s)}"
+        return sha1s[0]
 
-        files = os.listdir(dirname)
-        obj_file = ""
-        if len(sha1_prefix) == 2:
-            assert len(files) == 1, "multiple or none objects matched"
-            obj_file = files[0]
-        else:
-            for file in files:
-                if file.startswith(sha1_prefix[2:]):
-                    obj_file = os.path.join(dirname, file)
-                    break
+    @classmethod
+    def __match_sha1s(cls, sha1_prefix, repo_path):
+        sha1s = set()
+        loose_sha1s = cls.__get_loose_sha1s(repo_path)
+        i = bisect.bisect_left(loose_sha1s, sha1_prefix)
+        while i < len(loose_sha1s) and loose_sha1s[i].startswith(sha1_prefix):
+            sha1s.add(loose_sha1s[i])
+            i += 1
+        for _, sha1, _ in Pack.find_packed(sha1_prefix, repo_path):
+            sha1s.add(sha1)
+        return sorted(sha1s)
+
+    # sorted ids of the loose objects, listed once per process
+    @classmethod
+    def __get_loose_sha1s(cls, repo_path):
+        if repo_path not in cls.__loose_sha1s:
+            objects_dir = os.path.join(repo_path, ".git", "objects")
+            sha1s = []
+            for dirname in os.listdir(objects_dir):
+                dirpath = os.path.join(objects_dir, dirname)
+                if len(dirname) == 2 and os.path.isdir(dirpath):
+                    sha1s.extend(dirname + name for name in os.listdir(dirpath))
+            sha1s.sort()
+            cls.__loose_sha1s[repo_path] = sha1s
+        return cls.__loose_sha1s[repo_path]
 
-        sha1 = obj_file[-21:-19] + obj_file[-18:]
+    @classmethod
+    def __add_loose_sha1(cls, sha1, repo_path):
+        if repo_path in cls.__loose_sha1s:
+            bisect.insort(cls.__loose_sha1s[repo_path], sha1)
+
+    # drop the loaded loose ids after loose objects are removed
+    @classmethod
+    def forget_loose_sha1s(cls, repo_path):
+        cls.__loose_sha1s.pop(repo_path, None)
+
+    # (path, sha1) of a loose object, (None, None) if it isn't stored as a loose object
+    @classmethod
+    def find_object(cls, sha1_prefix, repo_path):
+        sha1 = cls.resolve_sha1(sha1_prefix, repo_path)
+        obj_file = cls.__loose_path(sha1, repo_path)
+        if not os.path.exists(obj_file):
+            return None, None
         return obj_file, sha1
@@ -0,0 +1,71 @@
+import collections
+
+
+# byte bounded LRU caches of decoded objects, trees and commits are kept apart from blobs
+# so that a few large blobs can't evict the trees of a recursive walk
+class ObjectCache():
+    class Lru():
+        def __init__(self, budget):
+            self.__budget = budget
+            self.__size = 0
+            self.__entries = collections.OrderedDict()
+
+        def get(self, key):
+            value = self.__entries.get(key)
+            if value is not None:
+                self.__entries.move_to_end(key)
+            return value
+
+        def put(self, key, value, size):
+            # an object taking a large part of the budget would just flush everything else
+            if size > self.__budget // 4 or key in self.__entries:
+                return
+            self.__entries[key] = (value, size)
+            self.__size += size
+            while self.__size > self.__budget:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__size -= evicted_size
+
+        def getsize(self):
+            return self.__size
+
+        def clear(self):
+            self.__entries.clear()
+            self.__size = 0
+
+    def __init__(self, meta_budget=32 << 20, blob_budget=64 << 20):
+        self.__meta = self.Lru(meta_budget)
+        self.__blobs = self.Lru(blob_budget)
+        self.__hits = 0
+        self.__misses = 0
+
+    # keys are (repo path, sha1), an id alone is ambiguous when several repositories are read
+    def get(self, key):
+        entry = self.__meta.get(key) or self.__blobs.get(key)
+        if entry is None:
+            self.__misses += 1
+            return None
+        self.__hits += 1
+        return entry[0]
+
+    def put(self, key, obj, size, isblob):
+        if isblob:
+            self.__blobs.put(key, obj, size)
+        else:
+            self.__meta.put(key, obj, size)
+
+    def gethits(self):
+        return self.__hits
+
+    def getmisses(self):
+        return self.__misses
+
+    def getsize(self):
+        return self.__meta.getsize() + self.__blobs.getsize()
+
+    def clear(self):
+        self.__meta.clear()
+        self.__blobs.clear()
+
+    def __str__(self):
+        return f"object cache: {self.__hits} hits, {self.__misses} misses, {self.getsize()} bytes cached"
@@ -0,0 +1,439 @@
+import os
+
+import collections
+import hashlib
+import mmap
+import struct
+import tempfile
+import zlib
+
+
+# pack data file: "PACK" | version | count | entries... | sha1 of the above
+#   entry: type and size varint header | (base offset varint for ofs-delta) | zlib data
+# pack index: magic | version | fanout[256] | sorted names | offsets | pack sha1 | idx sha1
+#   names are the 20 hex chars object ids stored as 10 raw bytes
+class Pack():
+    OBJ_OFS_DELTA = 6
+
+    __magic = b"PACK"
+    __idx_magic = b"\xfftOc"
+    __version = 2
+    __header_len = 12
+    __idx_header_len = 8
+    __fanout_len = 256 * 4
+    __namelen = 10
+
+    __window = 10
+    __max_depth = 50
+    __max_delta_size = 1 << 20
+    __block_size = 16
+    __chunk_size = 1 << 16
+
+    # repo_path -> (mtime of the pack dir, {idx name: Pack})
+    __packs = dict()
+
+    def __init__(self, idx_path):
+        self.__idx_path = idx_path
+        self.__pack_path = idx_path[:-len(".idx")] + ".pack"
+
+        with open(self.__idx_path, "rb") as f:
+            self.__idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.__pack_path, "rb") as f:
+            self.__pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack(
+            "!4sL", self.__idx[:self.__idx_header_len])
+        assert magic == self.__idx_magic, "pack index magic check error"
+        assert version == self.__version, "pack index version check error"
+        self.__fanout = struct.unpack(
+            "!256L", self.__idx[self.__idx_header_len:self.__idx_header_len + self.__fanout_len])
+        self.__count = self.__fanout[-1]
+        self.__names_off = self.__idx_header_len + self.__fanout_len
+        self.__offsets_off = self.__names_off + self.__count * self.__namelen
+
+        magic, version, count = struct.unpack(
+            "!4sLL", self.__pack[:self.__header_len])
+        assert magic == self.__magic, "pack magic check error"
+        assert version == self.__version, "pack version check error"
+        assert count == self.__count, "pack and its index are inconsistent"
+
+    def getpath(self):
+        return self.__pack_path
+
+    def getcount(self):
+        return self.__count
+
+    def getsha1(self, i):
+        return self.__getrawname(i).hex()
+
+    def get_sha1s(self):
+        return [self.getsha1(i) for i in range(self.__count)]
+
+    def __getrawname(self, i):
+        off = self.__names_off + i * self.__namelen
+        return self.__idx[off:off + self.__namelen]
+
+    def __getoffset(self, i):
+        return struct.unpack_from("!Q", self.__idx, self.__offsets_off + i * 8)[0]
+
+    # binary search the names in the fanout bucket of the prefix's first byte
+    def __lower_bound(self, key):
+        lo = self.__fanout[key[0] - 1] if key[0] > 0 else 0
+        hi = self.__fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__getrawname(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha1_prefix):
+        sha1_prefix = sha1_prefix.lower()
+        key = bytes.fromhex(sha1_prefix.ljust(self.__namelen * 2, "0"))
+        matches = []
+        i = self.__lower_bound(key)
+        while i < self.__count:
+            sha1 = self.getsha1(i)
+            if not sha1.startswith(sha1_prefix):
+                break
+            matches.append((sha1, self.__getoffset(i)))
+            i += 1
+        return matches
+
+    def get_offset(self, sha1):
+        key = bytes.fromhex(sha1)
+        i = self.__lower_bound(key)
+        if i < self.__count and self.__getrawname(i) == key:
+            return self.__getoffset(i)
+        return None
+
+    def read(self, offset):
+        # follow the delta chain down to its base object, then apply the deltas back up
+        delta_offs = []
+        while True:
+            obj_type, _, data_off = self.__read_header(offset)
+            if obj_type != self.OBJ_OFS_DELTA:
+                break
+            base_rel, data_off = self.__read_ofs(data_off)
+            delta_offs.append(data_off)
+            offset -= base_rel
+
+        content = self.__inflate(data_off)
+        for delta_off in reversed(delta_offs):
+            content = self.apply_delta(content, self.__inflate(delta_off))
+        return obj_type, content
+
+    # a base object is inflated chunk by chunk, a delta has to be materialized
+    def stream(self, offset):
+        obj_type, size, data_off = self.__read_header(offset)
+        if obj_type == self.OBJ_OFS_DELTA:
+            obj_type, content = self.read(offset)
+            return obj_type, len(content), iter([content])
+        return obj_type, size, self.__inflate_chunks(data_off)
+
+    # type and size of an object without inflating it, a delta only inflates the start of its data
+    # for the target size and takes the type of the base at the end of its chain
+    def read_type_size(self, offset):
+        obj_type, size, data_off = self.__read_header(offset)
+        if obj_type != self.OBJ_OFS_DELTA:
+            return obj_type, size
+
+        data = b""
+        chunks = self.__inflate_chunks(self.__read_ofs(data_off)[1])
+        for chunk in chunks:
+            data += chunk
+            # two varints of at most 10 bytes
+            if len(data) >= 20:
+                break
+        chunks.close()
+        _, pos = self.__decode_varint(data, 0)
+        size, _ = self.__decode_varint(data, pos)
+
+        while obj_type == self.OBJ_OFS_DELTA:
+            base_rel, _ = self.__read_ofs(data_off)
+            offset -= base_rel
+            obj_type, _, data_off = self.__read_header(offset)
+        return obj_type, size
+
+    def __read_header(self, pos):
+        c = self.__pack[pos]
+        obj_type = (c >> 4) & 0x7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            pos += 1
+            c = self.__pack[pos]
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return obj_type, size, pos + 1
+
+    def __read_ofs(self, pos):
+        c = self.__pack[pos]
+        rel = c & 0x7f
+        while c & 0x80:
+            pos += 1
+            c = self.__pack[pos]
+            rel = ((rel + 1) << 7) | (c & 0x7f)
+        return rel, pos + 1
+
+    def __inflate(self, pos):
+        return b"".join(self.__inflate_chunks(pos))
+
+    def __inflate_chunks(self, pos):
+        decompressor = zlib.decompressobj()
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail
+            if len(data) == 0:
+                data = self.__pack[pos:pos + self.__chunk_size]
+                pos += len(data)
+            assert len(data) != 0, f"pack {self.__pack_path} is truncated"
+            chunk = decompressor.decompress(data, self.__chunk_size)
+            if len(chunk) != 0:
+                yield chunk
+
+    @classmethod
+    def get_packs(cls, repo_path):
+        pack_dir = os.path.join(repo_path, ".git", "objects", "pack")
+        if not os.path.isdir(pack_dir):
+            return []
+
+        # only rescan the pack dir when a pack is added or removed
+        mtime = os.stat(pack_dir).st_mtime_ns
+        cached_mtime, packs = cls.__packs.get(repo_path, (None, dict()))
+        if cached_mtime != mtime:
+            names = [name for name in sorted(os.listdir(pack_dir))
+                     if name.endswith(".idx")]
+            packs = {name: packs[name] if name in packs else Pack(os.path.join(pack_dir, name))
+                     for name in names}
+            cls.__packs[repo_path] = (mtime, packs)
+        return list(packs.values())
+
+    # (pack, sha1, offset) of all the packed objects matching the prefix
+    @classmethod
+    def find_packed(cls, sha1_prefix, repo_path):
+        matches = []
+        for pack in cls.get_packs(repo_path):
+            for sha1, offset in pack.find(sha1_prefix):
+                matches.append((pack, sha1, offset))
+        return matches
+
+    # objects: (sha1, obj_type, obj_len) of every object to pack, read_content(sha1) returns its content
+    @classmethod
+    def write_pack(cls, objects, repo_path, read_content):
+        pack_dir = os.path.join(repo_path, ".git", "objects", "pack")
+        os.makedirs(pack_dir, exist_ok=True)
+
+        # objects of the same type and similar size are the likely delta bases of each other
+        objects = sorted(objects, key=lambda obj: (obj[1], obj[2]), reverse=True)
+
+        offsets = dict()
+        # (obj_type, content, depth, offset) of the recent delta base candidates
+        window = collections.deque(maxlen=cls.__window)
+        fd, tmp_pack = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+        with os.fdopen(fd, "wb") as f:
+            hasher = hashlib.sha1()
+            pos = 0
+
+            def write(data):
+                nonlocal pos
+                hasher.update(data)
+                f.write(data)
+                pos += len(data)
+
+            write(struct.pack("!4sLL", cls.__magic,
+                  cls.__version, len(objects)))
+            for sha1, obj_type, _ in objects:
+                content = read_content(sha1)
+                offsets[sha1] = pos
+
+                base, delta = None, None
+                if len(content) <= cls.__max_delta_size:
+                    for candidate in window:
+                        if candidate[0] != obj_type or candidate[2] >= cls.__max_depth:
+                            continue
+                        cdelta = cls.create_delta(candidate[1], content)
+                        if len(cdelta) < len(content) // 2 and (delta is None or len(cdelta) < len(delta)):
+                            base, delta = candidate, cdelta
+
+                if delta is not None:
+                    write(cls.__encode_header(cls.OBJ_OFS_DELTA, len(delta)) +
+                          cls.__encode_ofs(pos - base[3]) + zlib.compress(delta))
+                    depth = base[2] + 1
+                else:
+                    write(cls.__encode_header(obj_type, len(content)) +
+                          zlib.compress(content))
+                    depth = 0
+
+                if len(content) <= cls.__max_delta_size:
+                    window.append((obj_type, content, depth, offsets[sha1]))
+
+            checksum = hasher.digest()
+            f.write(checksum)
+
+        name = f"pack-{checksum.hex()}"
+        pack_path = os.path.join(pack_dir, name + ".pack")
+        os.replace(tmp_pack, pack_path)
+        # the index is renamed last, so a pack is never visible without its data
+        cls.__write_idx(os.path.join(pack_dir, name + ".idx"),
+                        offsets, checksum)
+        return pack_path
+
+    @classmethod
+    def __write_idx(cls, idx_path, offsets, checksum):
+        sha1s = sorted(offsets.keys())
+        fanout = [0] * 256
+        for sha1 in sha1s:
+            fanout[int(sha1[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        idata = struct.pack("!4sL", cls.__idx_magic, cls.__version) + \
+            struct.pack("!256L", *fanout) + \
+            b"".join(bytes.fromhex(sha1) for sha1 in sha1s) + \
+            b"".join(struct.pack("!Q", offsets[sha1]) for sha1 in sha1s) + \
+            checksum
+        idata += hashlib.sha1(idata).digest()
+
+        fd, tmp_idx = tempfile.mkstemp(
+            dir=os.path.dirname(idx_path), prefix="tmp_idx_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(idata)
+        os.replace(tmp_idx, idx_path)
+
+    @classmethod
+    def __encode_header(cls, obj_type, size):
+        c = (obj_type << 4) | (size & 0x0f)
+        size >>= 4
+        header = bytearray()
+        while size:
+            header.append(c | 0x80)
+            c = size & 0x7f
+            size >>= 7
+        header.append(c)
+        return bytes(header)
+
+    @classmethod
+    def __encode_ofs(cls, rel):
+        ofs = bytearray([rel & 0x7f])
+        rel >>= 7
+        while rel:
+            rel -= 1
+            ofs.insert(0, 0x80 | (rel & 0x7f))
+            rel >>= 7
+        return bytes(ofs)
+
+    @classmethod
+    def __encode_varint(cls, n):
+        varint = bytearray()
+        while n >= 0x80:
+            varint.append(0x80 | (n & 0x7f))
+            n >>= 7
+        varint.append(n)
+        return bytes(varint)
+
+    @classmethod
+    def __decode_varint(cls, data, pos):
+        n = 0
+        shift = 0
+        while True:
+            c = data[pos]
+            pos += 1
+            n |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return n, pos
+
+    # delta: base size | target size | instructions...
+    #   copy:   1oooossss + offset and size bytes flagged by the o and s bits
+    #   insert: 0nnnnnnn + n literal bytes
+    @classmethod
+    def create_delta(cls, base, target):
+        bs = cls.__block_size
+        blocks = dict()
+        for i in range(0, len(base) - bs + 1, bs):
+            blocks.setdefault(base[i:i + bs], i)
+
+        delta = [cls.__encode_varint(len(base)),
+                 cls.__encode_varint(len(target))]
+        literal = 0
+        i = 0
+        while i + bs <= len(target):
+            pos = blocks.get(target[i:i + bs])
+            if pos is None:
+                i += 1
+                continue
+
+            # extend the match backwards into the pending literal, then forwards
+            while i > literal and pos > 0 and target[i - 1] == base[pos - 1]:
+                i -= 1
+                pos -= 1
+            length = bs
+            while (i + length + bs <= len(target) and pos + length + bs <= len(base) and length + bs <= 0xFFFFFF and
+                   target[i + length:i + length + bs] == base[pos + length:pos + length + bs]):
+                length += bs
+            while (i + length < len(target) and pos + length < len(base) and length < 0xFFFFFF and
+                   target[i + length] == base[pos + length]):
+                length += 1
+
+            cls.__append_insert(delta, target[literal:i])
+            delta.append(cls.__encode_copy(pos, length))
+            i += length
+            literal = i
+        cls.__append_insert(delta, target[literal:])
+        return b"".join(delta)
+
+    @classmethod
+    def __append_insert(cls, delta, data):
+        for i in range(0, len(data), 0x7f):
+            chunk = data[i:i + 0x7f]
+            delta.append(bytes([len(chunk)]) + chunk)
+
+    @classmethod
+    def __encode_copy(cls, offset, size):
+        cmd = 0x80
+        args = bytearray()
+        for i in range(4):
+            c = (offset >> (8 * i)) & 0xff
+            if c:
+                cmd |= 1 << i
+                args.append(c)
+        for i in range(3):
+            c = (size >> (8 * i)) & 0xff
+            if c:
+                cmd |= 0x10 << i
+                args.append(c)
+        return bytes([cmd]) + bytes(args)
+
+    @classmethod
+    def apply_delta(cls, base, delta):
+        base_len, pos = cls.__decode_varint(delta, 0)
+        target_len, pos = cls.__decode_varint(delta, pos)
+        assert base_len == len(base), "delta base size mismatch"
+
+        target = bytearray()
+        while pos < len(delta):
+            cmd = delta[pos]
+            pos += 1
+            if cmd & 0x80:
+                offset = 0
+                size = 0
+                for i in range(4):
+                    if cmd & (1 << i):
+                        offset |= delta[pos] << (8 * i)
+                        pos += 1
+                for i in range(3):
+                    if cmd & (0x10 << i):
+                        size |= delta[pos] << (8 * i)
+                        pos += 1
+                if size == 0:
+                    size = 0x10000
+                target += base[offset:offset + size]
+            elif cmd:
+                target += delta[pos:pos + cmd]
+                pos += cmd
+            else:
+                assert False, "invalid delta instruction"
+
+        assert len(target) == target_len, "delta target size mismatch"
+        return bytes(target)
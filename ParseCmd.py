@@ -1,8 +1,18 @@
+import sys
 import argparse
 
 
+def add_parallel_args(cmd):
+    cmd.add_argument("-j", "--jobs", type=int, default=None, dest="jobs",
+                     help="number of parallel workers (default: number of cores)")
+    cmd.add_argument("--process", action="store_true", dest="process",
+                     help="use a process pool instead of a thread pool")
+
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+                        help="print the object cache statistics to stderr when the command ends")
     subparsers = parser.add_subparsers(dest="command")
     init_cmd = subparsers.add_parser("init", help='initialize a new repo')
     init_cmd.add_argument(
@@ -13,12 +23,16 @@ def parse_cmd():
     hashobj_cmd.add_argument(
         "-t", "--type", choices=["blob"], default="blob", dest="type", help="Specify the type (default: \"blob\").")
     hashobj_cmd.add_argument(
-        "--path", dest="path", help="Create an empty Git repository or reinitialize an existing one")
+        "--path", dest="paths", nargs="+", help="Create an empty Git repository or reinitialize an existing one")
+    add_parallel_args(hashobj_cmd)
 
     add_cmd = subparsers.add_parser(
         "add", help="Add file contents to the index")
     add_cmd.add_argument(dest="paths", nargs="+",
                          help="path(s) of files to add")
+    add_cmd.add_argument("-f", "--force", action="store_true", dest="force",
+                         help="allow adding otherwise ignored files")
+    add_parallel_args(add_cmd)
     lsfile_cmd = subparsers.add_parser(
         "ls-files", help="List all the stage files")
     lsfile_cmd.add_argument("-s", "--stage", action="store_true", dest="stage",
@@ -42,6 +56,8 @@ def parse_cmd():
 
     diff_cmd = subparsers.add_parser(
         "diff", help="Show changes between commits, commit and working tree, etc")
+    diff_cmd.add_argument(
+        dest="names", nargs="*", help="two commits (branch, tag or hash number) to compare")
 
     commit_cmd = subparsers.add_parser(
         "commit", help="Record changes to the repository")
@@ -54,9 +70,18 @@ def parse_cmd():
         "--cached", action="store_true", dest="index", help="checkout index")
     checkout_cmd.add_argument(
         dest="names", nargs="?", help="branch name")
+    add_parallel_args(checkout_cmd)
 
     log_cmd = subparsers.add_parser(
-        "log")
+        "log", help="Show commit logs")
+    log_cmd.add_argument("-n", "--max-count", type=int, default=None, dest="max_count",
+                         help="limit the number of commits to output")
+    log_cmd.add_argument("--since", default=None, dest="since",
+                         help="show commits more recent than a date (unix seconds, iso date or \"<n> days ago\")")
+    log_cmd.add_argument("--oneline", action="store_true", dest="oneline",
+                         help="show each commit on a single line")
+    log_cmd.add_argument(dest="rev", nargs="?", default=None,
+                         help="commit or range A..B (default: HEAD)")
 
     branch_cmd = subparsers.add_parser(
         "branch", help="List, create, or delete branches")
@@ -87,4 +112,56 @@ def parse_cmd():
         dest="paths", nargs="+", help="file to be removed"
     )
 
-    return parser.parse_args()
+    fsmonitor_cmd = subparsers.add_parser(
+        "fsmonitor", help="Run a daemon watching the working tree, so that status needn't walk it")
+    fsmonitor_cmd.add_argument(choices=["start", "stop", "status", "run"], dest="action",
+                               help="run stays in the foreground")
+    fsmonitor_cmd.add_argument("--poll", action="store_true", dest="poll",
+                               help="poll the working tree instead of using inotify")
+
+    commit_graph_cmd = subparsers.add_parser(
+        "commit-graph", help="Write the commit-graph file of the commits reachable from the refs")
+    commit_graph_cmd.add_argument(choices=["write"], dest="action")
+    commit_graph_cmd.add_argument("--changed-paths", action="store_true", dest="changed_paths",
+                                  help="also compute the changed-path bloom filters used by log -- <path>")
+
+    merge_base_cmd = subparsers.add_parser(
+        "merge-base", help="Check whether a commit is an ancestor of another one")
+    merge_base_cmd.add_argument("--is-ancestor", action="store_true", dest="is_ancestor",
+                                help="exit with status 0 if the first commit is an ancestor of the second one")
+    merge_base_cmd.add_argument(dest="names", nargs=2, help="two commits (branch, tag or hash number)")
+
+    updateindex_cmd = subparsers.add_parser(
+        "update-index", help="Modify the index")
+    updateindex_cmd.add_argument("--index-version", type=int, choices=[2, 4], default=None, dest="version",
+                                 help="write the index in this format, 4 compresses the path prefixes")
+
+    updateref_cmd = subparsers.add_parser(
+        "update-ref", help="Update refs safely, in a single transaction with --stdin")
+    updateref_cmd.add_argument("--stdin", action="store_true", dest="stdin",
+                               help="read update/create/delete/verify commands from stdin")
+    updateref_cmd.add_argument("-d", action="store_true", dest="delete", help="delete the ref")
+    updateref_cmd.add_argument(dest="args", nargs="*", help="<ref> <new> [<old>], or <ref> [<old>] with -d")
+
+    packrefs_cmd = subparsers.add_parser(
+        "pack-refs", help="Pack the branches and tags into the packed-refs file")
+
+    repack_cmd = subparsers.add_parser(
+        "repack", help="Pack all the reachable objects into a single pack")
+
+    gc_cmd = subparsers.add_parser(
+        "gc", help="Repack the objects and prune the unreachable loose objects")
+    gc_cmd.add_argument(
+        "--prune", default=None, dest="prune", help="prune loose objects older than <seconds>, or \"now\" (default: 2 weeks)")
+
+    # argparse can't tell the revision from the paths after "--" for log, they are split here
+    argv = sys.argv[1:]
+    paths = []
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    if command == "log" and "--" in argv:
+        paths = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    if args.command == "log":
+        args.paths = paths
+    return args
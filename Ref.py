@@ -1,6 +1,307 @@
 import os
+import mmap
 
-from utils import bread, bwrite, is_hexdigits
+from utils import bread, is_hexdigits, LockFile
+
+
+# branches and tags, either loose (one file per ref under refs/<kind>) or in the packed-refs file,
+# a loose ref overrides the packed one. packed-refs is sorted by ref name so that a single ref is
+# found by bisection, and the listing of each kind is cached for the process
+class RefStore():
+    __instance = None
+    __init = False
+
+    __packed_header = b"# pack-refs with: sorted\n"
+    __hashlen = 20
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        self.__packed_path = os.path.join(repo_path, ".git", "packed-refs")
+        self.__packed = None
+        self.__packed_stamp = None
+        # kind -> {name: sha1}
+        self.__cache = dict()
+
+    def __loose_path(self, kind, name):
+        return os.path.join(self.__repo_path, ".git", "refs", kind, name)
+
+    def __load_packed(self):
+        try:
+            fstat = os.stat(self.__packed_path)
+        except FileNotFoundError:
+            self.__packed, self.__packed_stamp = None, None
+            return None
+        stamp = (fstat.st_mtime_ns, fstat.st_size, fstat.st_ino)
+        if stamp != self.__packed_stamp:
+            self.__packed = None
+            if fstat.st_size != 0:
+                with open(self.__packed_path, "rb") as f:
+                    self.__packed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__packed_stamp = stamp
+        return self.__packed
+
+    # start of the first line whose ref name is >= refname, lines are "<sha1> <ref name>\n"
+    def __bisect_packed(self, packed, refname):
+        lo = len(self.__packed_header) if packed[:len(self.__packed_header)] == self.__packed_header else 0
+        hi = len(packed)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = max(packed.rfind(b"\n", lo, mid) + 1, lo)
+            end = packed.find(b"\n", start)
+            if end < 0:
+                end = len(packed)
+            if packed[start + self.__hashlen + 1:end] < refname:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def __read_packed(self, kind, name):
+        packed = self.__load_packed()
+        if packed is None:
+            return None
+        refname = f"refs/{kind}/{name}".encode()
+        start = self.__bisect_packed(packed, refname)
+        end = packed.find(b"\n", start)
+        if end < 0:
+            end = len(packed)
+        if start < len(packed) and packed[start + self.__hashlen + 1:end] == refname:
+            return packed[start:start + self.__hashlen].decode()
+        return None
+
+    def __list_packed(self, kind):
+        refs = dict()
+        packed = self.__load_packed()
+        if packed is None:
+            return refs
+        prefix = f"refs/{kind}/".encode()
+        offset = self.__bisect_packed(packed, prefix)
+        while offset < len(packed):
+            end = packed.find(b"\n", offset)
+            if end < 0:
+                end = len(packed)
+            refname = packed[offset + self.__hashlen + 1:end]
+            if not refname.startswith(prefix):
+                break
+            refs[refname[len(prefix):].decode()] = packed[offset:offset + self.__hashlen].decode()
+            offset = end + 1
+        return refs
+
+    # sha1 of the ref, None if it doesn't exist
+    def read(self, kind, name):
+        if kind in self.__cache:
+            return self.__cache[kind].get(name)
+        path = self.__loose_path(kind, name)
+        if os.path.isfile(path):
+            return bread(path).decode()
+        return self.__read_packed(kind, name)
+
+    def exists(self, kind, name):
+        return self.read(kind, name) is not None
+
+    def list(self, kind):
+        if kind not in self.__cache:
+            refs = self.__list_packed(kind)
+            for name in self.__list_loose_names(kind):
+                refs[name] = bread(self.__loose_path(kind, name)).decode()
+            self.__cache[kind] = refs
+        return dict(self.__cache[kind])
+
+    def write(self, kind, name, sha1):
+        txn = RefTransaction(self.__repo_path)
+        txn.update(f"refs/{kind}/{name}", sha1)
+        txn.commit()
+
+    def delete(self, kind, name):
+        txn = RefTransaction(self.__repo_path)
+        txn.delete(f"refs/{kind}/{name}")
+        txn.commit()
+
+    # file of a ref name: "HEAD" or "refs/<kind>/<name>"
+    def get_ref_path(self, refname):
+        return os.path.join(self.__repo_path, ".git", refname)
+
+    # current value of a ref name bypassing the cache, None if it doesn't exist
+    def resolve(self, refname):
+        path = self.get_ref_path(refname)
+        if os.path.isfile(path):
+            return bread(path).decode()
+        if refname.startswith("refs/"):
+            _, kind, name = refname.split("/", 2)
+            return self.__read_packed(kind, name)
+        return None
+
+    def is_packed(self, refname):
+        if not refname.startswith("refs/"):
+            return False
+        _, kind, name = refname.split("/", 2)
+        return self.__read_packed(kind, name) is not None
+
+    # content of packed-refs without the ref names removed
+    def packed_without(self, removed):
+        refs = {f"refs/{kind}/{name}": sha1 for kind in ["heads", "tags"]
+                for name, sha1 in self.__list_packed(kind).items()}
+        for refname in removed:
+            refs.pop(refname, None)
+        return self.__serialize_packed(refs)
+
+    def get_packed_path(self):
+        return self.__packed_path
+
+    # the refs were changed on disk, drop everything read so far
+    def forget(self):
+        self.__cache = dict()
+        self.__load_packed()
+
+    # move all the branches and tags into packed-refs and remove their loose files, refs without a
+    # commit yet stay loose. packed-refs is locked first, then every loose ref is locked and read again
+    # under its lock, so that an update landing meanwhile is neither lost nor overwritten: a ref locked
+    # by someone else stays loose, and a loose file is only pruned while its lock is held
+    def pack_refs(self):
+        with LockFile(self.__packed_path) as packed_lock:
+            self.forget()
+            refs = {f"refs/{kind}/{name}": sha1 for kind in ["heads", "tags"]
+                    for name, sha1 in self.__list_packed(kind).items()}
+            locks = []
+            pruned = []
+            try:
+                for kind in ["heads", "tags"]:
+                    for name in self.__list_loose_names(kind):
+                        path = self.__loose_path(kind, name)
+                        lock = LockFile(path, must_lock=False)
+                        if not lock.islocked():
+                            continue
+                        locks.append(lock)
+                        if not os.path.isfile(path):
+                            continue
+                        sha1 = bread(path).decode()
+                        if sha1 == "":
+                            continue
+                        refs[f"refs/{kind}/{name}"] = sha1
+                        pruned.append(path)
+
+                packed_lock.write(self.__serialize_packed(refs))
+                packed_lock.commit()
+                for path in pruned:
+                    os.unlink(path)
+            finally:
+                for lock in locks:
+                    lock.rollback()
+                self.forget()
+        return len(refs)
+
+    # the lock files of the refs being updated aren't refs
+    def __list_loose_names(self, kind):
+        loose_dir = os.path.join(self.__repo_path, ".git", "refs", kind)
+        return sorted(name for name in os.listdir(loose_dir) if not name.endswith(".lock"))
+
+    def __serialize_packed(self, refs):
+        return self.__packed_header + b"".join(f"{refs[refname]} {refname}\n".encode()
+                                               for refname in sorted(refs))
+
+
+# a batch of ref updates applied all or nothing. every ref is locked, the expected old values are
+# checked under the locks, then all the new values are written and fsynced in one pass before
+# the renames. ref names are "HEAD" (written as is, it isn't dereferenced) or "refs/<kind>/<name>"
+class RefTransaction():
+    # as old value: the ref must not exist
+    zero_sha1 = "0" * 20
+
+    def __init__(self, repo_path):
+        self.__repo_path = repo_path
+        self.__store = RefStore(repo_path)
+        # ref name -> (new value or None to delete, expected old value or None to skip the check)
+        self.__updates = dict()
+
+    def update(self, refname, new, old=None):
+        self.__check_name(refname)
+        assert refname not in self.__updates, f"multiple updates for ref {refname} not allowed"
+        if refname != "HEAD":
+            assert new == "" or (len(new) == 20 and is_hexdigits(new)), f"invalid sha1 {new} for {refname}"
+        self.__updates[refname] = (new, old)
+
+    def create(self, refname, new):
+        self.update(refname, new, self.zero_sha1)
+
+    def delete(self, refname, old=None):
+        self.__check_name(refname)
+        assert refname != "HEAD", "HEAD can't be deleted"
+        assert refname not in self.__updates, f"multiple updates for ref {refname} not allowed"
+        self.__updates[refname] = (None, old)
+
+    def verify(self, refname, old):
+        self.__check_name(refname)
+        assert refname not in self.__updates, f"multiple updates for ref {refname} not allowed"
+        self.__updates[refname] = (False, old)
+
+    def __check_name(self, refname):
+        assert refname == "HEAD" or (refname.count("/") == 2 and refname.split("/")[:2] in
+                                     (["refs", "heads"], ["refs", "tags"]) and refname.split("/")[2] != ""), \
+            f"invalid ref name {refname}"
+
+    def commit(self):
+        locks = []
+        try:
+            # a fixed order so that two transactions can't wait on each other
+            for refname in sorted(self.__updates):
+                locks.append(LockFile(self.__store.get_ref_path(refname)))
+
+            deleted = []
+            for lock, refname in zip(locks, sorted(self.__updates)):
+                new, old = self.__updates[refname]
+                cur = self.__store.resolve(refname)
+                if old == self.zero_sha1:
+                    assert cur is None, f"ref {refname} already exists"
+                elif old is not None:
+                    assert cur == old, f"ref {refname} is at {cur} but expected {old}"
+                if new is None:
+                    assert cur is not None, f"ref {refname} doesn't exist"
+                    deleted.append(refname)
+                elif new is not False:
+                    lock.write(new.encode())
+
+            packed_lock = None
+            if any(self.__store.is_packed(refname) for refname in deleted):
+                packed_lock = LockFile(self.__store.get_packed_path())
+                locks.append(packed_lock)
+                packed_lock.write(self.__store.packed_without(deleted))
+
+            # one fsync pass, then the renames
+            written = [lock for lock, refname in zip(locks, sorted(self.__updates))
+                       if self.__updates[refname][0] not in (None, False)]
+            if packed_lock is not None:
+                written.append(packed_lock)
+            for lock in written:
+                lock.sync()
+            dirs = set()
+            for lock in written:
+                lock.commit(sync=False)
+                dirs.add(os.path.dirname(lock.getpath()))
+            for refname in deleted:
+                path = self.__store.get_ref_path(refname)
+                if os.path.exists(path):
+                    os.unlink(path)
+                dirs.add(os.path.dirname(path))
+            for dirpath in dirs:
+                fd = os.open(dirpath, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            for lock in locks:
+                lock.rollback()
+            self.__store.forget()
+            self.__updates = dict()
 
 
 class Head():
@@ -44,20 +345,22 @@ class Head():
         return isinstance(self.__obj, str)
 
     def ref_to(self, obj):
+        txn = RefTransaction(self.__repo_path)
         # sha1
         if isinstance(obj, str):
             self.__obj = obj
-            bwrite(self.__path, self.__obj.encode())
+            txn.update("HEAD", self.__obj)
         # branch
         elif isinstance(obj, Branch):
             self.__obj = obj
-            bwrite(self.__path, self.__obj.get_full_name().encode())
+            txn.update("HEAD", self.__obj.get_full_name())
         # tag...refer to the sha1 refered by this tag
         elif isinstance(obj, Tag):
             self.__obj = obj.get_sha1()
-            bwrite(self.__path, self.__obj.encode())
+            txn.update("HEAD", self.__obj)
         else:
             assert False, "invalid deference..."
+        txn.commit()
 
     def get_sha1(self):
         if self.is_ref_branch():
@@ -84,21 +387,21 @@ class Branch():
                                     \n\t2. (bytes, repo_path)"
 
     def build_from_bytes(self, name, repo_path):
-        self.__path = os.path.join(repo_path, ".git", "refs", "heads", name)
-        assert os.path.exists(self.__path), f"branch {name} not exisit"
+        self.__store = RefStore(repo_path)
         self.__name = name
-        self.__sha1 = bread(self.__path).decode()
+        self.__sha1 = self.__store.read("heads", name)
+        assert self.__sha1 is not None, f"branch {name} not exisit"
         # assert self.__sha1 != "", f"branch {name} is empty"
 
     def build_from_memory(self, name, sha1, repo_path):
-        self.__path = os.path.join(repo_path, ".git", "refs", "heads", name)
+        self.__store = RefStore(repo_path)
         self.__name = name
         self.__sha1 = sha1
         self.set_sha1(self.__sha1)
 
     def set_sha1(self, sha1):
         self.__sha1 = sha1
-        bwrite(self.__path, sha1.encode())
+        self.__store.write("heads", self.__name, sha1)
 
     def get_name(self):
         return self.__name
@@ -111,22 +414,16 @@ class Branch():
 
     @classmethod
     def is_branch(cls, name, repo_path):
-        return name in cls.get_branches(repo_path).keys()
+        return RefStore(repo_path).exists("heads", name)
 
     @classmethod
     def get_branches(cls, repo_path):
-        brhes = dict()
-        brh_dir = os.path.join(repo_path, ".git", "refs", "heads")
-        for name in os.listdir(brh_dir):
-            branch = Branch(name, repo_path)
-            brhes[branch.get_name()] = branch.get_sha1()
-        return brhes
+        return RefStore(repo_path).list("heads")
 
     @classmethod
     def remove(cls, name, repo_path):
         assert cls.is_branch(name, repo_path), f"{name} is not a branch name"
-        brh_path = os.path.join(repo_path, ".git", "refs", "heads", name)
-        os.unlink(brh_path)
+        RefStore(repo_path).delete("heads", name)
 
 
 class Tag():
@@ -141,21 +438,21 @@ class Tag():
                                     \n\t2. (bytes, repo_path)"
 
     def build_from_bytes(self, name, repo_path):
-        self.__path = os.path.join(repo_path, ".git", "refs", "tags", name)
-        assert os.path.exists(self.__path), f"tag {name} not exisit"
+        self.__store = RefStore(repo_path)
         self.__name = name
-        self.__sha1 = bread(self.__path).decode()
+        self.__sha1 = self.__store.read("tags", name)
+        assert self.__sha1 is not None, f"tag {name} not exisit"
         # assert self.__sha1 != "", f"branch {name} is empty"
 
     def build_from_memory(self, name, sha1, repo_path):
-        self.__path = os.path.join(repo_path, ".git", "refs", "tags", name)
+        self.__store = RefStore(repo_path)
         self.__name = name
         self.__sha1 = sha1
         self.set_sha1(self.__sha1)
 
     def set_sha1(self, sha1):
         self.__sha1 = sha1
-        bwrite(self.__path, sha1.encode())
+        self.__store.write("tags", self.__name, sha1)
 
     def get_name(self):
         return self.__name
@@ -165,19 +462,13 @@ class Tag():
 
     @classmethod
     def is_tag(cls, name, repo_path):
-        return name in cls.get_tags(repo_path).keys()
+        return RefStore(repo_path).exists("tags", name)
 
     @classmethod
     def get_tags(cls, repo_path):
-        tags = dict()
-        tag_dir = os.path.join(repo_path, ".git", "refs", "tags")
-        for name in os.listdir(tag_dir):
-            tag = Tag(name, repo_path)
-            tags[tag.get_name()] = tag.get_sha1()
-        return tags
+        return RefStore(repo_path).list("tags")
 
     @classmethod
     def remove(cls, name, repo_path):
         assert cls.is_tag(name, repo_path), f"{name} is not a branch name"
-        tag_path = os.path.join(repo_path, ".git", "refs", "tags", name)
-        os.unlink(tag_path)
+        RefStore(repo_path).delete("tags", name)
@@ -0,0 +1,178 @@
+import os
+import stat
+import time
+
+from Object import Object
+from Pack import Pack
+from CommitGraph import CommitGraph
+from Ref import Head, Branch, Tag
+
+
+class Repacker():
+    __instance = None
+    __init = False
+
+    # unreachable loose objects younger than this are kept by gc, they may belong to a running command
+    __prune_expire = 2 * 7 * 24 * 3600
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance == None:
+            cls.__instance = object.__new__(cls)
+        return cls.__instance
+
+    def __init__(self, repo_path):
+        if self.__init:
+            return
+        self.__init = True
+
+        self.__repo_path = repo_path
+        self.__objects_dir = os.path.join(repo_path, ".git", "objects")
+
+    # pack every reachable object into one new pack, then drop the old packs and the packed loose objects
+    def repack(self, index):
+        reachable, nbytes = self.__repack(index)
+        print(f"reclaimed {self.__format_bytes(nbytes)}")
+        return reachable
+
+    # (reachable objects, bytes reclaimed). the unreachable objects of the old packs are written out as
+    # loose objects with the mtime of their pack, so that they get the grace period of gc too
+    def __repack(self, index):
+        reachable = self.__reachable_objects(index)
+        if len(reachable) == 0:
+            print("nothing to pack")
+            return reachable, 0
+
+        old_packs = Pack.get_packs(self.__repo_path)
+
+        # the sizes only need the object headers, the content is read once while packing
+        objects = []
+        for sha1, obj_type in reachable.items():
+            _, obj_len = Object.read_header(sha1, self.__repo_path)
+            objects.append((sha1, obj_type, obj_len))
+        pack_path = Pack.write_pack(objects, self.__repo_path,
+                                    lambda sha1: Object.read_object(sha1, self.__repo_path)[2])
+        # the same objects give the same pack, which is then kept as it is
+        old_paths = [pack.getpath() for pack in old_packs]
+        nbytes = 0 if pack_path in old_paths else -self.__pack_size(pack_path)
+
+        nexploded = 0
+        for pack in old_packs:
+            path = pack.getpath()
+            if path == pack_path:
+                continue
+            mtime = os.stat(path).st_mtime
+            for sha1 in pack.get_sha1s():
+                if sha1 not in reachable:
+                    obj_type, content = pack.read(pack.get_offset(sha1))
+                    if Object.write_loose(sha1, obj_type, content, self.__repo_path, mtime):
+                        nexploded += 1
+                        nbytes -= os.stat(Object.find_object(sha1, self.__repo_path)[0]).st_size
+            nbytes += self.__pack_size(path)
+            os.unlink(path[:-len(".pack")] + ".idx")
+            os.unlink(path)
+
+        nremoved = 0
+        for sha1, path in self.__loose_objects():
+            if sha1 in reachable:
+                nbytes += os.stat(path).st_size
+                os.unlink(path)
+                nremoved += 1
+        self.__clean_empty_dirs()
+        Object.forget_loose_sha1s(self.__repo_path)
+
+        print(f"packed {len(objects)} objects into {os.path.basename(pack_path)}, "
+              f"removed {nremoved} loose objects, unpacked {nexploded} unreachable objects")
+        return reachable, nbytes
+
+    def gc(self, index, expire=None):
+        if expire is None:
+            expire = self.__prune_expire
+
+        reachable, nbytes = self.__repack(index)
+
+        # whatever is still loose after repacking is unreachable
+        deadline = time.time() - expire
+        npruned = 0
+        for sha1, path in self.__loose_objects():
+            fstat = os.stat(path)
+            if sha1 not in reachable and fstat.st_mtime <= deadline:
+                os.unlink(path)
+                nbytes += fstat.st_size
+                npruned += 1
+        # temp files left behind by interrupted writes
+        for name in os.listdir(self.__objects_dir):
+            path = os.path.join(self.__objects_dir, name)
+            fstat = os.stat(path)
+            if name.startswith("tmp_") and fstat.st_mtime <= deadline:
+                os.unlink(path)
+                nbytes += fstat.st_size
+        self.__clean_empty_dirs()
+        Object.forget_loose_sha1s(self.__repo_path)
+
+        print(f"pruned {npruned} unreachable loose objects, reclaimed {self.__format_bytes(nbytes)}")
+
+    def __pack_size(self, pack_path):
+        return os.stat(pack_path).st_size + os.stat(pack_path[:-len(".pack")] + ".idx").st_size
+
+    # a negative count means the objects take more space than before
+    @classmethod
+    def __format_bytes(cls, nbytes):
+        size = abs(nbytes)
+        for unit in ("bytes", "KiB", "MiB"):
+            if size < 1024 or unit == "MiB":
+                break
+            size /= 1024
+        text = f"{size} {unit}" if unit == "bytes" else f"{size:.2f} {unit}"
+        return text if nbytes >= 0 else "-" + text
+
+    # sha1 -> object type of everything reachable from the refs, HEAD and the index
+    def __reachable_objects(self, index):
+        reachable = dict()
+        graph = CommitGraph(self.__repo_path)
+
+        commits = list(Branch.get_branches(self.__repo_path).values()) + \
+            list(Tag.get_tags(self.__repo_path).values()) + \
+            [Head(self.__repo_path).get_sha1()]
+        stack = [(sha1, Object.ObjType.COMMIT) for sha1 in commits if sha1]
+        for ientry in index.get_ientries():
+            stack.append((ientry.getsha1(), Object.ObjType.BLOB))
+
+        while len(stack) != 0:
+            sha1, obj_type = stack.pop()
+            if sha1 in reachable:
+                continue
+            reachable[sha1] = obj_type
+
+            if obj_type == Object.ObjType.BLOB:
+                continue
+            # the commits in the commit-graph needn't be inflated
+            if obj_type == Object.ObjType.COMMIT:
+                stack.append((graph.get_tree_sha1(sha1), Object.ObjType.TREE))
+                for parent_sha1 in graph.get_parent_sha1s(sha1):
+                    stack.append((parent_sha1, Object.ObjType.COMMIT))
+                continue
+            obj = Object(sha1, self.__repo_path)
+            if obj.istree():
+                for tentry in obj.getrawobj().iter_tentries():
+                    if stat.S_ISDIR(tentry.getmode()):
+                        stack.append((tentry.getsha1(), Object.ObjType.TREE))
+                    else:
+                        stack.append((tentry.getsha1(), Object.ObjType.BLOB))
+
+        return reachable
+
+    def __loose_objects(self):
+        loose = []
+        for dirname in os.listdir(self.__objects_dir):
+            dirpath = os.path.join(self.__objects_dir, dirname)
+            if len(dirname) != 2 or not os.path.isdir(dirpath):
+                continue
+            for name in os.listdir(dirpath):
+                loose.append((dirname + name, os.path.join(dirpath, name)))
+        return loose
+
+    def __clean_empty_dirs(self):
+        for dirname in os.listdir(self.__objects_dir):
+            dirpath = os.path.join(self.__objects_dir, dirname)
+            if len(dirname) == 2 and os.path.isdir(dirpath) and len(os.listdir(dirpath)) == 0:
+                os.rmdir(dirpath)
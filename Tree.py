@@ -5,30 +5,32 @@ class Tree():
 
     class TreeEntry():
         def __init__(self, *args, **kwargs):
+            self.__blen = 0
+
             if (len(args)) + (len(kwargs)) == 3:
                 self.build_from_memory(*args, **kwargs)
-            elif (len(args)) + (len(kwargs)) == 1:
+            elif (len(args)) + (len(kwargs)) in (1, 2):
                 self.build_from_bytes(*args, **kwargs)
             else:
                 assert False, "invalid construction, accepted construction parameters:\
                                 \n\t1. (mode, path, sha1)\
-                                \n\t2. (bytes)"
-
-            self.__blen = 0
+                                \n\t2. (bytes, [offset])"
 
         def build_from_memory(self, mode, path, sha1):
             self.__mode = mode
             self.__path = path
             self.__sha1 = sha1
 
-        def build_from_bytes(self, tdata):
-            mode, tdata = tdata.split(b" ", maxsplit=1)
-            self.__mode = int(mode, 8)  # mode is stored as a octal str number
+        # parse the entry starting at offset in place, only the fields themselves are copied
+        def build_from_bytes(self, tdata, offset=0):
+            space = tdata.index(b" ", offset)
+            self.__mode = int(tdata[offset:space], 8)  # mode is stored as a octal str number
 
-            path, tdata = tdata.split(b"\x00", maxsplit=1)
-            self.__path = path.decode()
+            nul = tdata.index(b"\x00", space)
+            self.__path = tdata[space + 1:nul].decode()
 
-            self.__sha1 = tdata[:20].decode()
+            self.__sha1 = tdata[nul + 1:nul + 21].decode()
+            self.__blen = nul + 21 - offset
 
         def serialization(self):
             return f"{self.__mode:o} {self.__path}\x00{self.__sha1}".encode()
@@ -56,6 +58,10 @@ class Tree():
 
     def __init__(self, *args, **kwargs):
         self.__tentries = {}
+        # raw tree data and entry offsets of the entries not materialized yet
+        self.__tdata = None
+        self.__offsets = None
+        self.__names = None
 
         if (len(args)) + (len(kwargs)) == 1:
             self.build_from_bytes(*args, **kwargs)
@@ -66,22 +72,61 @@ class Tree():
                             \n\t1. ()\
                             \n\t2. (bytes)"
 
+    # only the entry boundaries are found here, each one is parsed when it is accessed
     def build_from_bytes(self, tdata):
-        blen = len(tdata)
-        while blen > 0:
-            entry = self.TreeEntry(tdata)
+        tdata = bytes(tdata)
+        offsets = []
+        offset = 0
+        while offset < len(tdata):
+            offsets.append(offset)
+            offset = tdata.index(b"\x00", offset) + 21
+
+        self.__tdata = tdata
+        self.__offsets = offsets
+
+    def __materialize(self):
+        if self.__offsets is None:
+            return
+        for offset in self.__offsets:
+            entry = self.TreeEntry(self.__tdata, offset)
             self.__tentries[entry.getpath()] = entry
-            tdata = tdata[entry.getbytelen():]
-
-            blen -= entry.getbytelen()
+        self.__tdata = None
+        self.__offsets = None
+        self.__names = None
 
     def add_tentry(self, mode, path, sha1):
+        self.__materialize()
         self.__tentries[path] = self.TreeEntry(mode, path, sha1)
 
     def get_tentries(self):
+        self.__materialize()
         return list(self.__tentries.values())
 
+    def iter_tentries(self):
+        if self.__offsets is None:
+            yield from self.__tentries.values()
+            return
+        for offset in self.__offsets:
+            yield self.TreeEntry(self.__tdata, offset)
+
+    def get_tentry(self, path):
+        if self.__offsets is None:
+            return self.__tentries.get(path)
+
+        if self.__names is None:
+            self.__names = dict()
+            for offset in self.__offsets:
+                space = self.__tdata.index(b" ", offset)
+                nul = self.__tdata.index(b"\x00", space)
+                self.__names[self.__tdata[space + 1:nul]] = offset
+        offset = self.__names.get(path.encode())
+        return None if offset is None else self.TreeEntry(self.__tdata, offset)
+
     def serialization(self):
+        # an unmodified tree serializes to the bytes it was parsed from
+        if self.__offsets is not None:
+            return self.__tdata
+
         btentries = []
         for entry in self.__tentries.values():
             btentries.append(entry.serialization())
@@ -89,7 +134,7 @@ class Tree():
 
     def __str__(self):
         out = ""
-        for entry in self.__tentries.values():
+        for entry in self.iter_tentries():
             out += f"{entry.getmode():0>6o} {entry.gettypename()} {entry.getsha1()}\t{entry.getpath()}\n"
 
         return out[:-1]  # move the last '\n' char
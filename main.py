@@ -1,11 +1,17 @@
 import os
+import sys
 import struct
 import stat
 import subprocess
 import tempfile
+import time
+import datetime
+import atexit
 
 from utils import bread, bwrite
-from Index import Index
+import functools
+
+from Index import Index, hash_file, checkout_file
 from ParseCmd import parse_cmd
 import difflib
 import zlib
@@ -17,8 +23,14 @@ from Tree import Tree
 from Blob import Blob
 from Commit import Commit
 from Commitor import Commitor
-from Ref import Branch, Head, Tag
-from utils import is_hexdigits, ColorEscape, can_cvt2str
+from Repacker import Repacker
+from Differ import Differ
+from Ignore import Ignore
+from FsMonitor import FsMonitor
+from CommitGraph import CommitGraph
+from ChangedPaths import ChangedPaths
+from Ref import Branch, Head, Tag, RefStore, RefTransaction
+from utils import is_hexdigits, ColorEscape, can_cvt2str, parallel_map
 
 
 class CatMode(enum.IntEnum):
@@ -36,6 +48,7 @@ class GitRepo():
     __init = False
 
     __editor = "vim"
+    __parallel_checkout_threshold = 32
 
     def __new__(cls, *args, **kwargs):
         if cls.__instance == None:
@@ -51,10 +64,16 @@ class GitRepo():
 
         self.__repo_path = None
         self.__index = None
+        self.__ignore = None
 
-    def init_repo_path(self):
+    # the commands modifying the index lock it before reading it, the lock is dropped on exit
+    # if they didn't write it
+    def init_repo_path(self, lock_index=False):
         self.__repo_path = self.get_repo_path()
-        self.__index = Index(self.__repo_path, self.__version)
+        self.__index = Index(self.__repo_path, self.__version, lock_index)
+        if lock_index:
+            atexit.register(self.__index.unlock_index)
+        self.__ignore = Ignore(self.__repo_path)
 
     def get_repo_path(self):
         if self.__repo_path != None:
@@ -87,26 +106,46 @@ class GitRepo():
         os.mknod(os.path.join(git_path, "refs", "heads", "master"))
         os.mknod(os.path.join(git_path, "index"))  # index
 
-    def add(self, paths):
+    def add(self, paths, jobs=None, use_process=False, force=False):
         # remove repeted path...converted list to set
         paths = set(paths)
+        # explicitly named paths that are ignored and not tracked yet are refused without force,
+        # the other paths are still added
+        ignored = []
         for path in paths.copy():
-            if os.path.isdir(path):
+            isdir = os.path.isdir(path)
+            relpath = os.path.relpath(os.path.realpath(path), self.__repo_path)
+            if not force and relpath != "." and not self.__index.has_ientry(relpath) and \
+                    self.__ignore.is_ignored(relpath, isdir):
+                paths.remove(path)
+                ignored.append(path)
+            elif isdir:
                 paths.remove(path)
-                paths.update(self.__files_under_dir(path))
+                paths.update(self.__files_under_dir(path, not force))
 
-        for path in paths:
-            self.__index.add_ientry(path)
+        self.__index.add_ientries(paths, jobs, use_process)
 
         self.__index.write_index()
 
+        if len(ignored) != 0:
+            print("The following paths are ignored by one of your .gitignore files:", file=sys.stderr)
+            for path in sorted(ignored):
+                print(path, file=sys.stderr)
+            print("hint: Use -f if you really want to add them.", file=sys.stderr)
+            sys.exit(1)
+
+    def hash_object(self, paths, jobs=None, use_process=False):
+        results = parallel_map(functools.partial(hash_file, repo_path=self.__repo_path),
+                               paths, jobs, use_process)
+        for _, _, sha1 in results:
+            print(sha1)
+
     def ls_file(self, stage):
         if stage:
             print(self.__index)
         else:
-            ientries = self.__index.get_ientries()
-            for ientry in ientries:
-                print(ientry.getpath())
+            for path in self.__index.get_paths():
+                print(path)
 
     def status(self):
         fchanged, fcreate, fdelete = self.__diff_index2commit()
@@ -122,7 +161,12 @@ class GitRepo():
         for path in fcreate:
             print(f"{ColorEscape.white}untracted: \t{path}")
 
-    def diff(self):
+    def diff(self, names=None):
+        if names:
+            assert len(names) == 2, "only support diff between two commits"
+            self.__diff_commits(*names)
+            return
+
         fchanged, _, _ = self.__diff_working2index()
 
         ientry_map = {ientry.getpath(): ientry.getsha1()
@@ -146,47 +190,171 @@ class GitRepo():
             for diff_line in difflib.unified_diff(file_lines, blob_lines, os.path.join("a", path), os.path.join("b", path)):
                 print(diff_line)
 
-    def __diff_working2index(self):
-        fpaths = self.__files_under_dir(self.__repo_path)
+    def __diff_commits(self, old_name, new_name):
+        graph = CommitGraph(self.__repo_path)
+        fchanged, fcreate, fdelete = Differ(self.__repo_path).diff_trees(
+            graph.get_tree_sha1(self.__resolve_commit(old_name)),
+            graph.get_tree_sha1(self.__resolve_commit(new_name)))
+
+        diffs = [(path, old_sha1, new_sha1)
+                 for path, (old_sha1, new_sha1) in fchanged.items()]
+        diffs += [(path, None, sha1) for path, sha1 in fcreate.items()]
+        diffs += [(path, sha1, None) for path, sha1 in fdelete.items()]
+        for path, old_sha1, new_sha1 in sorted(diffs):
+            old_data = Object(old_sha1, self.__repo_path).getrawobj(
+            ).serialization() if old_sha1 else b""
+            new_data = Object(new_sha1, self.__repo_path).getrawobj(
+            ).serialization() if new_sha1 else b""
+            if not can_cvt2str(old_data) or not can_cvt2str(new_data):
+                print(
+                    f"\n{ColorEscape.red}{path} is modified, but is not a txt file, can not to be diffed{ColorEscape.white}\n")
+                continue
 
-        ientry_map = {entry.getpath(): entry.getsha1()
-                      for entry in self.__index.get_ientries()}
-        ientry_paths = set(ientry_map.keys())
+            old_lines = old_data.decode().splitlines()
+            new_lines = new_data.decode().splitlines()
+            old_path = os.path.join("a", path) if old_sha1 else "/dev/null"
+            new_path = os.path.join("b", path) if new_sha1 else "/dev/null"
+            for diff_line in difflib.unified_diff(old_lines, new_lines, old_path, new_path, lineterm=""):
+                print(diff_line)
 
-        fcreate = fpaths - ientry_paths
-        fdelete = ientry_paths - fpaths
+    # sha1 of the commit referred by a branch, a tag, HEAD or a hash number (prefix)
+    def __resolve_commit(self, name):
+        if name == "HEAD":
+            sha1 = Head(self.__repo_path).get_sha1()
+        elif Branch.is_branch(name, self.__repo_path):
+            sha1 = Branch(name, self.__repo_path).get_sha1()
+        elif Tag.is_tag(name, self.__repo_path):
+            sha1 = Tag(name, self.__repo_path).get_sha1()
+        else:
+            sha1 = Object.resolve_sha1(name, self.__repo_path)
+        assert sha1 != "", f"{name} doesn't refer to any commit"
+        return sha1
 
-        fchanged = set()
-        for path in fpaths.intersection(ientry_paths):
-            data = bread(os.path.join(self.__repo_path, path))
-            obj = Object(Blob(data), self.__repo_path)
-            if obj.hash_object(write=False) != ientry_map[path]:
-                fchanged.add(path)
-        return fchanged, fcreate, fdelete
+    def __diff_working2index(self):
+        # with a running fsmonitor only the paths it reports and the ones that were dirty
+        # at the last query are checked, instead of every tracked path and dir
+        old_token, pending = self.__index.get_fsmonitor()
+        token, changed = FsMonitor(self.__repo_path).query(old_token)
+        if changed is None:
+            candidates = self.__index.get_paths()
+            changed_dirs = None
+        else:
+            candidates = self.__tracked_under(changed | pending)
+            changed_dirs = changed | {os.path.dirname(path) for path in changed}
 
-    def __diff_index2commit(self):
-        ientry_map = {entry.getpath(): entry.getsha1()
-                      for entry in self.__index.get_ientries()}
-        ientry_paths = set(ientry_map.keys())
+        fcreate = set()
+        dirty = self.__untracked_files("", fcreate, changed_dirs)
 
-        commit = Object(Head(self.__repo_path).get_sha1(),
-                        self.__repo_path).getrawobj()
-        tentry_map = {entry.getpath(): entry.getsha1()
-                      for entry in Commitor(self.__repo_path).read_tree(commit)}
-        tentry_paths = set(tentry_map.keys())
+        fchanged = set()
+        fdelete = set()
+        for path in candidates:
+            fpath = os.path.join(self.__repo_path, path)
+            try:
+                fstat = os.lstat(fpath)
+            except (FileNotFoundError, NotADirectoryError):
+                fdelete.add(path)
+                continue
+            if stat.S_ISDIR(fstat.st_mode):
+                fdelete.add(path)
+                continue
 
-        fcreate = ientry_paths - tentry_paths
-        fdelete = tentry_paths - ientry_paths
+            ientry = self.__index.get_ientry(path)
+            # stat data unchanged, skip rehashing the content
+            if ientry.match_stat(fstat) and not self.__index.is_racy(ientry):
+                continue
 
-        fchanged = set()
-        for path in tentry_paths.intersection(ientry_paths):
-            if tentry_map[path] != ientry_map[path]:
+            # a chmod alone is a change too
+            if ientry.getmode() != fstat.st_mode or \
+                    Object.hash_file(fpath, self.__repo_path, write=False) != ientry.getsha1():
                 fchanged.add(path)
-
+            else:
+                self.__index.refresh_ientry(path, fstat)
+                dirty = True
+
+        if token is not None and (token != old_token or pending != fchanged | fdelete):
+            self.__index.set_fsmonitor(token, fchanged | fdelete)
+            dirty = True
+        # only a cache of what was found, skipped when another process holds or changed the index
+        if dirty:
+            self.__index.write_index(must_write=False)
         return fchanged, fcreate, fdelete
 
+    # the tracked paths among paths, or under them when they are dirs
+    def __tracked_under(self, paths):
+        tracked = {path for path in paths if self.__index.has_ientry(path)}
+        # a path that is now a file can't be a dir with tracked files in it
+        dirs = {path + os.path.sep for path in paths - tracked
+                if not os.path.isfile(os.path.join(self.__repo_path, path))}
+        if len(dirs) != 0:
+            for path in self.__index.get_paths():
+                for dirpath in self.__parent_dirs(path):
+                    if dirpath in dirs:
+                        tracked.add(path)
+                        break
+        return tracked
+
+    def __parent_dirs(self, path):
+        end = path.find(os.path.sep)
+        while end >= 0:
+            yield path[:end + 1]
+            end = path.find(os.path.sep, end + 1)
+
+    # collect the untracked files under dirpath into untracked, a dir whose mtime is the same as in the
+    # untracked cache isn't listed again, nor stated if the fsmonitor didn't report it in changed_dirs.
+    # return whether the cache was updated
+    def __untracked_files(self, dirpath, untracked, changed_dirs=None):
+        cached = self.__index.get_untracked(dirpath)
+        if cached is not None and changed_dirs is not None and dirpath not in changed_dirs:
+            return self.__collect_untracked(dirpath, cached[1], cached[2], untracked, changed_dirs)
+
+        fdirpath = os.path.join(self.__repo_path, dirpath)
+        try:
+            mtime_ns = os.stat(fdirpath).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            self.__index.remove_untracked(dirpath)
+            return True
+
+        dirty = False
+        if cached is not None and cached[0] == mtime_ns and not self.__index.is_racy_mtime(mtime_ns):
+            _, names, subdirs = cached
+        else:
+            names, subdirs = [], []
+            with os.scandir(fdirpath) as it:
+                for entry in it:
+                    if dirpath == "" and entry.name == ".git":
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif not self.__index.has_ientry(os.path.join(dirpath, entry.name)):
+                        names.append(entry.name)
+            self.__index.set_untracked(dirpath, mtime_ns, names, subdirs)
+            dirty = True
+        return self.__collect_untracked(dirpath, names, subdirs, untracked, changed_dirs) or dirty
+
+    def __collect_untracked(self, dirpath, names, subdirs, untracked, changed_dirs):
+        dirty = False
+        # files added since the dir was listed are still in the cached names. the ignore rules are
+        # applied here so that the cache stays valid when they change, ignored dirs are never visited
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if not self.__index.has_ientry(path) and not self.__ignore.is_ignored(path):
+                untracked.add(path)
+        for name in subdirs:
+            path = os.path.join(dirpath, name)
+            if not self.__ignore.is_ignored(path, True):
+                dirty |= self.__untracked_files(path, untracked, changed_dirs)
+        return dirty
+
+    def __diff_index2commit(self):
+        tree_sha1 = None
+        head_sha1 = Head(self.__repo_path).get_sha1()
+        if head_sha1 != "":
+            tree_sha1 = CommitGraph(self.__repo_path).get_tree_sha1(head_sha1)
+
+        return Differ(self.__repo_path).diff_index_tree(self.__index, tree_sha1)
+
     # relpaths from repo_path...
-    def __files_under_dir(self, root_dir):
+    def __files_under_dir(self, root_dir, ignore=True):
         fpaths = set()
         for root, dirs, files in os.walk(root_dir):
             if (os.path.realpath(root) == self.__repo_path):
@@ -194,7 +362,12 @@ class GitRepo():
 
             files = {os.path.relpath(os.path.join(
                 root, file), self.__repo_path) for file in files}
-            # TODO: can ignore some files here...
+            if ignore:
+                # prune the ignored dirs in place so that os.walk doesn't descend into them
+                relroot = os.path.relpath(root, self.__repo_path)
+                dirs[:] = [d for d in dirs if not self.__ignore.is_ignored(
+                    os.path.normpath(os.path.join(relroot, d)), True)]
+                files = {file for file in files if not self.__ignore.is_ignored(file)}
             fpaths.update(files)
         return fpaths
 
@@ -218,31 +391,42 @@ class GitRepo():
                     assert False, "not a dir or symlink->dir"
 
     def cat_file(self, mode, sha1_prefix):
-        obj = Object(sha1_prefix, self.__repo_path)
-
-        if (mode == CatMode.TYPE):
-            print(obj.gettypename())
-        elif (mode == CatMode.SIZE):
-            print(obj.getlen())
-        elif (mode == CatMode.PRETTY):
-            assert obj_type == ObjType.BLOB, "only support blob..."
-            print(obj.getrawobj())
-        elif (mode == CatMode.BLOB):
-            assert obj.isblob(), "object type is not blob..."
-            blob = obj.getrawobj()
-            if blob.can_cvt2str():
-                print(blob)
+        # type and size only need the object header
+        obj_type, obj_len = Object.read_header(sha1_prefix, self.__repo_path)
+        if mode == CatMode.TYPE:
+            print(Object.ObjType.getname(obj_type))
+            return
+        if mode == CatMode.SIZE:
+            print(obj_len)
+            return
+
+        # blobs are streamed, trees and commits are printed from the decoded object
+        if mode == CatMode.PRETTY:
+            if obj_type == Object.ObjType.BLOB:
+                self.__print_blob(sha1_prefix)
             else:
-                print(blob.serialization())
+                print(Object(sha1_prefix, self.__repo_path).getrawobj())
+        elif (mode == CatMode.BLOB):
+            assert obj_type == Object.ObjType.BLOB, "object type is not blob..."
+            self.__print_blob(sha1_prefix)
         elif (mode == CatMode.TREE):
-            assert obj.istree(), "object type is not tree..."
-            print(obj.getrawobj())
+            assert obj_type == Object.ObjType.TREE, "object type is not tree..."
+            print(Object(sha1_prefix, self.__repo_path).getrawobj())
         elif (mode == CatMode.COMMIT):
-            assert obj.iscommit(), "object type is not commit..."
-            print(obj.getrawobj())
+            assert obj_type == Object.ObjType.COMMIT, "object type is not commit..."
+            print(Object(sha1_prefix, self.__repo_path).getrawobj())
         else:
             assert False, "only support blob..."
 
+    def __print_blob(self, sha1_prefix):
+        _, _, chunks = Object.stream_object(sha1_prefix, self.__repo_path)
+        self.__write_stdout(chunks)
+
+    def __write_stdout(self, chunks):
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+
     def commit(self, msg):
         commior = Commitor(self.__repo_path)
         if msg == None:
@@ -257,54 +441,170 @@ class GitRepo():
 
         commior.commit(self.__index, msg)
 
-    def log(self):
-        commitor = Commitor(self.__repo_path)
-        commitor.log()
+    # revs: "B", "A..B", "A.." or "..B", an empty side means HEAD
+    def log(self, rev=None, max_count=None, since=None, oneline=False, paths=None):
+        include, exclude = ["HEAD"], []
+        if rev is not None and ".." in rev:
+            old, new = rev.split("..", 1)
+            include, exclude = [new or "HEAD"], [old or "HEAD"]
+        elif rev is not None:
+            include = [rev]
+        if Head(self.__repo_path).get_sha1() == "" and include == ["HEAD"] and len(exclude) == 0:
+            return
 
-    def checkout(self, name, index=False):
+        commitor = Commitor(self.__repo_path)
+        commitor.log([self.__resolve_commit(name) for name in include],
+                     [self.__resolve_commit(name) for name in exclude],
+                     max_count, self.__parse_since(since), oneline, self.__to_repo_paths(paths))
+
+    # pathspecs relative to the current dir -> paths relative to the repository, None for the whole tree
+    def __to_repo_paths(self, paths):
+        if not paths:
+            return None
+        repo_paths = []
+        for path in paths:
+            path = os.path.relpath(os.path.realpath(path), self.__repo_path)
+            assert not path.startswith(".."), f"{path} is outside the repository"
+            if path == ".":
+                return None
+            repo_paths.append(path)
+        return repo_paths
+
+    # unix seconds, an iso date or "<n> <seconds|minutes|hours|days|weeks> ago"
+    def __parse_since(self, since):
+        if since is None:
+            return None
+        if since.isdigit():
+            return int(since)
+        units = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+        words = since.split()
+        if len(words) == 3 and words[0].isdigit() and words[2] == "ago" and words[1].rstrip("s") in units:
+            return int(time.time()) - int(words[0]) * units[words[1].rstrip("s")]
+        try:
+            return int(datetime.datetime.fromisoformat(since).timestamp())
+        except ValueError:
+            assert False, f"invalid date {since}"
+
+    def checkout(self, name, index=False, jobs=None, use_process=False):
         if index:
             if not name:
-                self.__remove_tracted_files()
-                self.__clean_empty_dirs_under_dir(self.__repo_path)
-                for entry in self.__index.get_ientries():
-                    self.__restore_index2working(entry.getpath())
+                fchanged, _, fdelete = self.__diff_working2index()
+                files = {os.path.join(self.__repo_path, path): self.__index.get_ientry(path).getsha1()
+                         for path in fchanged | fdelete}
+                for fpath, _, fstat in self.__checkout_files(files, jobs, use_process):
+                    self.__index.refresh_ientry(
+                        os.path.relpath(fpath, self.__repo_path), fstat)
             else:
                 self.__restore_index2working(name)
+            self.__index.write_index()
         else:
-            self.__remove_tracted_files()
             head = Head(self.__repo_path)
             # print(name.isnumeric() and len(name) >= 2)
+            target = None
             sha1 = None
             if is_hexdigits(name) and len(name) >= 2:
                 sha1_prefix = name
-                _, sha1 = Object.find_object(sha1_prefix, self.__repo_path)
-                head.ref_to(sha1)
-                print(f"set hash {sha1}")
+                sha1 = Object.resolve_sha1(sha1_prefix, self.__repo_path)
+                target = sha1
             elif not is_hexdigits(name):
                 if Branch.is_branch(name, self.__repo_path):
-                    head.ref_to(Branch(name, self.__repo_path))
+                    target = Branch(name, self.__repo_path)
                 elif Tag.is_tag(name, self.__repo_path):
-                    head.ref_to(Tag(name, self.__repo_path))
-                sha1 = head.get_sha1()
-                print("checkout ", name)
+                    target = Tag(name, self.__repo_path)
+                else:
+                    assert False, f"{name} is neither a branch nor a tag"
+                sha1 = target.get_sha1()
             else:
                 assert False, "invalid head"
-            commit = Object(head.get_sha1(), self.__repo_path).getrawobj()
 
-            self.__index.reset_to_commit(commit)
-            self.checkout(name=None, index=True)
+            self.__switch_commit(head.get_sha1(), sha1, jobs, use_process)
+            head.ref_to(target)
+            if isinstance(target, str):
+                print(f"set hash {sha1}")
+            else:
+                print("checkout ", name)
 
-    def __restore_index2working(self, path):
-        bdata = self.__index.get_bytedata(path)
-        path = os.path.join(self.__repo_path, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        bwrite(path, bdata)
+    # only apply the files that differ between the two commits, the other index entries
+    # and their stat data are left untouched
+    def __switch_commit(self, old_sha1, new_sha1, jobs=None, use_process=False):
+        graph = CommitGraph(self.__repo_path)
+        old_tree = graph.get_tree_sha1(old_sha1) if old_sha1 != "" else None
+        new_tree = graph.get_tree_sha1(new_sha1)
+        fchanged, fcreate, fdelete = Differ(
+            self.__repo_path).diff_trees(old_tree, new_tree)
+
+        for path, (old_blob, _) in fchanged.items():
+            self.__check_overwritable(path, old_blob)
+        for path in fcreate:
+            self.__check_overwritable(path, None)
+        for path, old_blob in fdelete.items():
+            self.__check_overwritable(path, old_blob)
 
-    def __remove_tracted_files(self):
-        _, fcreate, _ = self.__diff_working2index()
-        for file in self.__files_under_dir(self.__repo_path):
-            if file not in fcreate:
-                os.unlink(os.path.join(self.__repo_path, file))
+        for path in fdelete:
+            fpath = os.path.join(self.__repo_path, path)
+            if os.path.lexists(fpath):
+                os.unlink(fpath)
+            if self.__index.has_ientry(path):
+                self.__index.remove_ientry(path)
+            self.__remove_empty_parents(fpath)
+
+        files = {os.path.join(self.__repo_path, path): new_blob
+                 for path, (_, new_blob) in fchanged.items()}
+        files.update({os.path.join(self.__repo_path, path): new_blob
+                      for path, new_blob in fcreate.items()})
+        for fpath, sha1, fstat in self.__checkout_files(files, jobs, use_process):
+            self.__index.add_hashed_ientry(fpath, sha1, fstat)
+
+        # the subtrees the index now matches are known to be the ones of the new commit
+        Differ(self.__repo_path).diff_index_tree(self.__index, new_tree, seed=True)
+        self.__index.write_index()
+
+    # a file is only replaced when both the index and the working tree still hold the old commit's version
+    def __check_overwritable(self, path, old_blob):
+        index_blob = self.__index.get_ientry(path).getsha1() \
+            if self.__index.has_ientry(path) else None
+        assert index_blob == old_blob, f"your staged changes to {path} would be overwritten by checkout"
+
+        fpath = os.path.join(self.__repo_path, path)
+        if not os.path.lexists(fpath):
+            return
+        assert index_blob is not None, f"untracked file {path} would be overwritten by checkout"
+        ientry = self.__index.get_ientry(path)
+        fstat = os.lstat(fpath)
+        if ientry.match_stat(fstat) and not self.__index.is_racy(ientry):
+            return
+        assert Object.hash_file(fpath, self.__repo_path, write=False) == index_blob, \
+            f"your local changes to {path} would be overwritten by checkout"
+
+    def __remove_empty_parents(self, fpath):
+        dirpath = os.path.dirname(fpath)
+        while dirpath != self.__repo_path and os.path.isdir(dirpath) and len(os.listdir(dirpath)) == 0:
+            os.rmdir(dirpath)
+            dirpath = os.path.dirname(dirpath)
+
+    # files: fpath -> blob sha1. the dirs are created in one pass, then the blobs are inflated and
+    # written across a pool of workers, small checkouts aren't worth the pool and run serially
+    def __checkout_files(self, files, jobs=None, use_process=False):
+        for dirpath in sorted({os.path.dirname(fpath) for fpath in files}):
+            os.makedirs(dirpath, exist_ok=True)
+
+        if len(files) < self.__parallel_checkout_threshold:
+            jobs = 1
+        return parallel_map(functools.partial(checkout_file, repo_path=self.__repo_path),
+                            files.items(), jobs, use_process)
+
+    def __restore_index2working(self, path):
+        sha1 = self.__index.get_ientry(path).getsha1()
+        fpath = os.path.join(self.__repo_path, path)
+        self.__write_blob(fpath, sha1)
+        self.__index.refresh_ientry(path, os.lstat(fpath))
+
+    def __write_blob(self, fpath, sha1):
+        _, _, chunks = Object.stream_object(sha1, self.__repo_path)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
 
     def branch(self, name, ls=False, rm=False):
         if ls:
@@ -334,12 +634,98 @@ class GitRepo():
             tag = Tag(name, sha1, self.__repo_path)
             print(f"create a new tag {name} at {sha1}")
 
+    def fsmonitor(self, action, poll=False):
+        monitor = FsMonitor(self.__repo_path)
+        if action == "run":
+            monitor.run(poll)
+        elif action == "start":
+            assert not monitor.is_running(), "fsmonitor is already running"
+            cmd = [sys.executable, os.path.realpath(__file__), "fsmonitor", "run"]
+            if poll:
+                cmd.append("--poll")
+            subprocess.Popen(cmd, cwd=self.__repo_path, start_new_session=True,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            print("fsmonitor started")
+        elif action == "stop":
+            print("fsmonitor stopped" if monitor.stop() else "fsmonitor is not running")
+        else:
+            print("fsmonitor is running" if monitor.is_running() else "fsmonitor is not running")
+
+    def commit_graph(self, action, changed_paths=False):
+        if action == "write":
+            count = CommitGraph(self.__repo_path).write()
+            print(f"wrote {count} commits to the commit-graph")
+            if changed_paths:
+                tips = list(Branch.get_branches(self.__repo_path).values()) + \
+                    list(Tag.get_tags(self.__repo_path).values()) + \
+                    [Head(self.__repo_path).get_sha1()]
+                count = ChangedPaths(self.__repo_path).add(
+                    list(Commitor(self.__repo_path).walk([sha1 for sha1 in tips if sha1])))
+                print(f"computed changed paths of {count} commits")
+
+    # exit status 0 if ancestor is an ancestor of name, 1 otherwise
+    def merge_base(self, ancestor, name):
+        if not CommitGraph(self.__repo_path).is_ancestor(self.__resolve_commit(ancestor),
+                                                         self.__resolve_commit(name)):
+            sys.exit(1)
+
+    # with stdin, one command per line, all applied in a single transaction:
+    #   update <ref> <new> [<old>] | create <ref> <new> | delete <ref> [<old>] | verify <ref> [<old>]
+    def update_ref(self, stdin=False, delete=False, args=()):
+        txn = RefTransaction(self.__repo_path)
+        if not stdin:
+            assert len(args) in ((1, 2) if delete else (2, 3)), "invalid update-ref arguments"
+            if delete:
+                txn.delete(*args)
+            else:
+                txn.update(*args)
+            txn.commit()
+            return
+
+        for line in sys.stdin:
+            words = line.split()
+            if len(words) == 0:
+                continue
+            command, params = words[0], words[1:]
+            if command == "update" and len(params) in (2, 3):
+                txn.update(*params)
+            elif command == "create" and len(params) == 2:
+                txn.create(*params)
+            elif command == "delete" and len(params) in (1, 2):
+                txn.delete(*params)
+            elif command == "verify" and len(params) in (1, 2):
+                # without an old value the ref must not exist
+                txn.verify(params[0], params[1] if len(params) == 2 else RefTransaction.zero_sha1)
+            else:
+                assert False, f"invalid update-ref command: {line.strip()}"
+        txn.commit()
+
+    def update_index(self, version=None):
+        if version is not None:
+            self.__index.set_version(version)
+        self.__index.write_index()
+
+    def pack_refs(self):
+        count = RefStore(self.__repo_path).pack_refs()
+        print(f"packed {count} refs")
+
+    def repack(self):
+        Repacker(self.__repo_path).repack(self.__index)
+
+    def gc(self, prune=None):
+        if prune == "now":
+            prune = 0
+        elif prune != None:
+            assert prune.isdigit(), "--prune expects a number of seconds or \"now\""
+            prune = int(prune)
+        Repacker(self.__repo_path).gc(self.__index, prune)
+
     def rm(self, paths, index=False):
         paths = set(paths)
         for path in paths.copy():
             if os.path.isdir(os.path.join(self.__repo_path, path)):
                 paths.remove(path)
-                paths.update(self.__files_under_dir(path))
+                paths.update(self.__files_under_dir(path, False))
 
         for path in paths:
             self.__index.remove_ientry(path)
@@ -356,13 +742,11 @@ if __name__ == "__main__":
     if args.command == "init":
         repo.init(args.path)
 
-    repo.init_repo_path()
+    repo.init_repo_path(lock_index=args.command in ("add", "rm", "commit", "checkout", "update-index"))
     if args.command == "hash-object":
-        data = bread(args.path)
-        obj = Object(Blob(data), repo.get_repo_path())
-        obj.hash_object()
+        repo.hash_object(args.paths, args.jobs, args.process)
     elif args.command == "add":
-        repo.add(args.paths)
+        repo.add(args.paths, args.jobs, args.process, args.force)
     elif args.command == "ls-files":
         repo.ls_file(args.stage)
     elif args.command == "status":
@@ -391,13 +775,13 @@ if __name__ == "__main__":
         repo.cat_file(mode, args.sha1_prefix)
 
     elif args.command == "diff":
-        repo.diff()
+        repo.diff(args.names)
     elif args.command == "commit":
         repo.commit(args.msg)
     elif args.command == "log":
-        repo.log()
+        repo.log(args.rev, args.max_count, args.since, args.oneline, args.paths)
     elif args.command == "checkout":
-        repo.checkout(args.names, args.index)
+        repo.checkout(args.names, args.index, args.jobs, args.process)
     elif args.command == "branch":
         if not args.ls:
             assert args.name != None, "no name specified"
@@ -412,5 +796,25 @@ if __name__ == "__main__":
         repo.tag(args.name, args.ls, args.rm)
     elif args.command == "rm":
         repo.rm(args.paths, args.index)
+    elif args.command == "fsmonitor":
+        repo.fsmonitor(args.action, args.poll)
+    elif args.command == "commit-graph":
+        repo.commit_graph(args.action, args.changed_paths)
+    elif args.command == "merge-base":
+        assert args.is_ancestor, "only support --is-ancestor"
+        repo.merge_base(*args.names)
+    elif args.command == "update-ref":
+        repo.update_ref(args.stdin, args.delete, args.args)
+    elif args.command == "update-index":
+        repo.update_index(args.version)
+    elif args.command == "pack-refs":
+        repo.pack_refs()
+    elif args.command == "repack":
+        repo.repack()
+    elif args.command == "gc":
+        repo.gc(args.prune)
     else:
         assert False, "invalid command"
+
+    if args.verbose:
+        print(Object.get_cache(), file=sys.stderr)
@@ -1,5 +1,7 @@
 import os
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 
 class ColorEscape():
     red = "\033[31m"
@@ -36,3 +38,74 @@ def can_cvt2str(data):
     except UnicodeDecodeError as e:
         return False
     return True
+
+
+# map func over items with a pool of jobs workers (default: one per core), falls back to a plain
+# loop for a single job or item. threads suit hashlib/zlib work since both release the GIL
+def parallel_map(func, items, jobs=None, use_process=False):
+    items = list(items)
+    jobs = jobs or os.cpu_count() or 1
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    executor = ProcessPoolExecutor if use_process else ThreadPoolExecutor
+    chunksize = max(1, len(items) // (jobs * 4))
+    with executor(max_workers=jobs) as pool:
+        return list(pool.map(func, items, chunksize=chunksize))
+
+
+# <path>.lock created exclusively, written, fsynced and renamed over path. whoever holds the
+# lock is the only writer of path, a crash leaves path either old or new but never torn
+class LockFile():
+    # without must_lock, a lock held by someone else isn't an error, islocked() tells whether it was taken
+    def __init__(self, path, must_lock=True):
+        self.__path = path
+        self.__lock_path = path + ".lock"
+        try:
+            self.__fd = os.open(self.__lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            assert not must_lock, f"unable to lock {path}, {self.__lock_path} exists"
+            self.__fd = None
+
+    def islocked(self):
+        return self.__fd is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.rollback()
+
+    def getpath(self):
+        return self.__path
+
+    # the lock file is created when it is taken, so this is the time the lock was taken
+    def getmtime_ns(self):
+        return os.fstat(self.__fd).st_mtime_ns
+
+    # a single write may be short, keep going until everything is written
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            data = data[os.write(self.__fd, data):]
+
+    def sync(self):
+        os.fsync(self.__fd)
+
+    def commit(self, sync=True):
+        if sync:
+            self.sync()
+        os.close(self.__fd)
+        self.__fd = None
+        try:
+            os.replace(self.__lock_path, self.__path)
+        except OSError:
+            os.unlink(self.__lock_path)
+            raise
+
+    # drop the lock, path is left untouched
+    def rollback(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            os.unlink(self.__lock_path)